@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Headless benchmarks for the ImageDisplayQT display pipeline.
+
+Drives ImageDisplay using the Qt offscreen platform and measures the time
+taken by set_image and by painting the widget (draw) for a range of image
+sizes, data types, mono and colour images, autoscale settings, zoom levels,
+numbers of overlays and graph lengths. Results are written as JSON so that
+they can be compared across commits.
+
+Usage:
+    python benchmark_display.py --output results.json
+    python benchmark_display.py --quick
+    python benchmark_display.py --compare old.json new.json
+
+@author: Mike Hughes, Applied Optics Group, Physics & Astronomy, University of Kent
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+
+# Must be set before Qt is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import numpy as np
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QT_VERSION_STR, PYQT_VERSION_STR
+from PyQt5.QtGui import QPen
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "src"))
+from image_display import ImageDisplay
+
+
+SIZES = [512, 1024, 2048, 4096, 8192]
+DTYPES = ['uint8', 'uint16', 'float32', 'float64']
+ZOOM_LEVELS = [0, 3]
+OVERLAY_COUNTS = [0, 100, 1000]
+OVERLAY_COLLECTION_COUNTS = [1000, 10000, 50000]
+GRAPH_LENGTHS = [1000, 100000, 1000000]
+
+QUICK_SIZES = [512, 1024]
+QUICK_GRAPH_LENGTHS = [1000, 100000]
+
+WIDGET_SIZE = (800, 800)
+
+
+def make_image(size, dtype, colour, seed = 0):
+    """ Returns a random test image of shape (size, size) or (size, size, 3)
+    covering a typical range for the data type.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (size, size, 3) if colour else (size, size)
+    if dtype == 'uint8':
+        return rng.integers(0, 256, shape, dtype = np.uint8)
+    elif dtype == 'uint16':
+        return rng.integers(0, 4096, shape, dtype = np.uint16)
+    else:
+        return (rng.random(shape, dtype = np.float32 if dtype == 'float32' else np.float64) * 1000)
+
+
+def time_call(func, repeats, minTime):
+    """ Calls func once to warm up, then repeatedly until it has been called
+    at least `repeats` times and minTime seconds have elapsed. Returns a dictionary
+    of timing statistics in ms.
+    """
+    func()
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeats or time.perf_counter() - start < minTime:
+        t1 = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - t1) * 1000)
+        if len(times) >= 10 * repeats:
+            break
+    times = np.array(times)
+    return {'mean_ms': float(np.mean(times)),
+            'median_ms': float(np.median(times)),
+            'min_ms': float(np.min(times)),
+            'std_ms': float(np.std(times)),
+            'repeats': len(times)}
+
+
+def new_display(app):
+    """ Creates and shows an ImageDisplay of the standard size.
+    """
+    display = ImageDisplay(name = "benchmark")
+    display.resizeDelay = 0
+    display.resize(*WIDGET_SIZE)
+    display.show()
+    app.processEvents()
+    return display
+
+
+def bench_set_image(app, display, sizes, repeats, minTime, maxMegabytes):
+    """ Measures set_image and draw for combinations of image size, data type,
+    mono/colour, autoscale and zoom.
+    """
+    results = []
+    for size in sizes:
+        for dtype in DTYPES:
+            for colour in (False, True):
+                megabytes = size * size * (3 if colour else 1) * np.dtype(dtype).itemsize / 1e6
+                if megabytes > maxMegabytes:
+                    continue
+                img = make_image(size, dtype, colour)
+                for autoScale in (True, False):
+                    for zoomLevel in ZOOM_LEVELS:
+                        display.set_auto_scale(autoScale)
+                        display.zoomLevel = zoomLevel
+                        display.zoomLocation = (size // 2, size // 2)
+                        display.set_image(img)
+
+                        params = {'size': size, 'dtype': dtype, 'colour': colour,
+                                  'autoscale': autoScale, 'zoom_level': zoomLevel}
+                        results.append({'benchmark': 'set_image', 'params': params,
+                                        **time_call(lambda: display.set_image(img), repeats, minTime)})
+                        results.append({'benchmark': 'draw', 'params': params,
+                                        **time_call(display.grab, repeats, minTime)})
+                        print_result(results[-2])
+                        print_result(results[-1])
+                del img
+    display.zoomLevel = 0
+    display.set_auto_scale(True)
+    return results
+
+
+def redraw_overlays(display):
+    """ Paints the widget with the overlays drawn again, rather than taken 
+    from the cached overlay layer.
+    """
+    display.update_overlays()
+    display.grab()
+
+
+def bench_overlays(app, display, repeats, minTime):
+    """ Measures draw with different numbers of overlays, with and without
+    the overlay layer cache, both when the overlays change before every paint
+    and when they are unchanged.
+    """
+    results = []
+    img = make_image(1024, 'uint8', False)
+    display.set_image(img)
+    rng = np.random.default_rng(1)
+    pen = QPen(Qt.green, 1, Qt.SolidLine)
+    for count in OVERLAY_COUNTS:
+        display.clear_overlays()
+        for x, y in rng.integers(0, 1000, (count, 2)):
+            display.add_overlay(ImageDisplay.RECTANGLE, int(x), int(y), 10, 10, pen, None)
+        results += bench_overlay_cache(display, {'size': 1024, 'overlays': count}, repeats, minTime)
+    for count in OVERLAY_COLLECTION_COUNTS:
+        display.clear_overlays()
+        x, y = rng.random((2, count)) * 1000
+        display.add_overlay_collection(ImageDisplay.RECTANGLE, x, y, 10, 10, pen, None)
+        results += bench_overlay_cache(display, {'size': 1024, 'collection': count}, repeats, minTime)
+    display.clear_overlays()
+    display.set_overlay_cache_enabled(True)
+    return results
+
+
+def bench_overlay_cache(display, params, repeats, minTime):
+    """ Measures painting with the current overlays, with and without the 
+    overlay layer cache. draw_overlays redraws the overlays before each 
+    paint, as when they are changed, draw_static_overlays paints with 
+    unchanged overlays, as when only the status bar is updated.
+    """
+    results = []
+    for useCache in (False, True):
+        display.set_overlay_cache_enabled(useCache)
+        cacheParams = {**params, 'overlay_cache': useCache}
+        results.append({'benchmark': 'draw_overlays', 'params': cacheParams,
+                        **time_call(lambda: redraw_overlays(display), repeats, minTime)})
+        print_result(results[-1])
+        results.append({'benchmark': 'draw_static_overlays', 'params': cacheParams,
+                        **time_call(display.grab, repeats, minTime)})
+        print_result(results[-1])
+    return results
+
+
+def bench_graphs(app, display, graphLengths, repeats, minTime):
+    """ Measures set_graph and draw for different graph lengths.
+    """
+    results = []
+    for length in graphLengths:
+        graph = np.sin(np.linspace(0, 100, length)) + np.random.default_rng(2).random(length) * 0.1
+        display.set_graph(graph)
+        params = {'length': length}
+        results.append({'benchmark': 'set_graph', 'params': params,
+                        **time_call(lambda: display.set_graph(graph), repeats, minTime)})
+        results.append({'benchmark': 'draw_graph', 'params': params,
+                        **time_call(display.grab, repeats, minTime)})
+        print_result(results[-2])
+        print_result(results[-1])
+    return results
+
+
+def print_result(result):
+    """ Prints a one line summary of a benchmark result.
+    """
+    params = ', '.join(key + '=' + str(value) for key, value in result['params'].items())
+    print(f"{result['benchmark']:20s} {params:70s} {result['median_ms']:10.3f} ms")
+
+
+def git_commit():
+    """ Returns the current git commit hash, or None if not available.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = Path(__file__).resolve().parent,
+                                       stderr = subprocess.DEVNULL, text = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    """ Returns a hashable key identifying a benchmark and its parameters.
+    """
+    return (result['benchmark'], tuple(sorted(result['params'].items())))
+
+
+def compare(oldFile, newFile, threshold):
+    """ Prints the change in median time for each benchmark present in both
+    results files, flagging those slower by more than `threshold` (fractional).
+    Returns the number of such regressions.
+    """
+    with open(oldFile) as f:
+        old = {result_key(r): r for r in json.load(f)['results']}
+    with open(newFile) as f:
+        new = {result_key(r): r for r in json.load(f)['results']}
+
+    regressions = 0
+    for key, result in new.items():
+        if key not in old:
+            continue
+        ratio = result['median_ms'] / max(old[key]['median_ms'], 1e-9)
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  <-- slower'
+            regressions = regressions + 1
+        params = ', '.join(k + '=' + str(v) for k, v in key[1])
+        print(f"{key[0]:20s} {params:70s} {old[key]['median_ms']:10.3f} -> {result['median_ms']:10.3f} ms  x{ratio:5.2f}{flag}")
+    print(f"{regressions} benchmarks slower by more than {threshold * 100:.0f}%")
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Headless benchmarks for ImageDisplayQT")
+    parser.add_argument('--output', default = 'benchmark_results.json', help = "JSON file to write results to")
+    parser.add_argument('--quick', action = 'store_true', help = "Run a reduced set of benchmarks")
+    parser.add_argument('--repeats', type = int, default = 5, help = "Minimum number of timed calls per benchmark")
+    parser.add_argument('--min-time', type = float, default = 0.2, help = "Minimum time in seconds per benchmark")
+    parser.add_argument('--max-megabytes', type = float, default = 1024, help = "Skip test images larger than this")
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'), help = "Compare two results files")
+    parser.add_argument('--threshold', type = float, default = 0.1, help = "Fractional slow down reported as a regression")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) > 0 else 0)
+
+    app = QApplication(sys.argv)
+    display = new_display(app)
+
+    sizes = QUICK_SIZES if args.quick else SIZES
+    graphLengths = QUICK_GRAPH_LENGTHS if args.quick else GRAPH_LENGTHS
+
+    results = []
+    results += bench_set_image(app, display, sizes, args.repeats, args.min_time, args.max_megabytes)
+    results += bench_overlays(app, display, args.repeats, args.min_time)
+    results += bench_graphs(app, display, graphLengths, args.repeats, args.min_time)
+
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'commit': git_commit(),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'qt': QT_VERSION_STR,
+                       'pyqt': PYQT_VERSION_STR,
+                       'platform': platform.platform(),
+                       'qpa_platform': os.environ.get('QT_QPA_PLATFORM'),
+                       'widget_size': WIDGET_SIZE,
+                       'quick': args.quick},
+              'results': results}
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -12,7 +12,6 @@ import sys
 import os
 
 import numpy as np
-from PIL import Image
 from pathlib import Path
 
 from PyQt5 import QtGui, QtCore, QtWidgets  
@@ -24,6 +23,7 @@ from PyQt5.QtGui import QPainter, QBrush, QPen
 
 sys.path.append(os.path.abspath("../src"))
 from image_display import ImageDisplay
+from image_display_sources import open_frame_source
 
 
 class ImageDisplayExample(QMainWindow):
@@ -35,7 +35,7 @@ class ImageDisplayExample(QMainWindow):
     monoImageSource = "example_mono8.tif"
     colourImageSource = "example_rgb.tif"
     
-    # Will try to load this number of images
+    # Will display at most this number of images
     numImagesToLoad = 50
          
     # Gui display defaults
@@ -46,7 +46,7 @@ class ImageDisplayExample(QMainWindow):
     GUIupdateInterval = 33
         
     currentImage = None
-    imageBuffer = None
+    frameSource = None
     currentImageNum = 0 
     GUITimer = None
     
@@ -70,6 +70,8 @@ class ImageDisplayExample(QMainWindow):
         """ 
         if self.GUITimer is not None:
             self.GUITimer.stop()
+        if self.frameSource is not None:
+            self.frameSource.close()
                 
         
     def create_layout(self):
@@ -171,34 +173,18 @@ class ImageDisplayExample(QMainWindow):
         else:
             filename = self.monoImageSource 
         
-        self.imageBuffer = self.load_images(filename, self.numImagesToLoad)
-        self.numLoadedImages = np.shape(self.imageBuffer)[3]
+        if self.frameSource is not None:
+            self.frameSource.close()
+        self.frameSource = self.load_images(filename)
+        self.numLoadedImages = min(self.frameSource.num_frames(), self.numImagesToLoad)
+        self.currentImageNum = 0
         
         
-    def load_images(self, filename, numToLoad):
-        """ Loads a stack of images into memmory from tif.
+    def load_images(self, filename):
+        """ Opens a tif stack as a frame source. Images are only read from the 
+        file when they are needed, and the next images are read in the background.
         """            
-        dataset = Image.open(filename)
-        h = np.shape(dataset)[0]
-        w = np.shape(dataset)[1]  
-        if np.shape(np.shape(dataset))[0] == 3:
-            c = np.shape(dataset)[2] 
-        else:
-            c = 1
-        nLoad = min(numToLoad, dataset.n_frames)
-
-        imageBuffer = np.zeros((h,w,c, nLoad))
-        
-        for i in range(min(dataset.n_frames, nLoad)):
-            dataset.seek(i)
-            if c > 1:
-                imageBuffer[:,:,:,i] = np.array(dataset).astype('double')
-            else:
-                imageBuffer[:,:,0,i] = np.array(dataset).astype('double')
-
-        dataset.close() 
-
-        return imageBuffer
+        return open_frame_source(filename)
 
     
     def update_gui(self):
@@ -252,7 +238,8 @@ class ImageDisplayExample(QMainWindow):
         # Grab the next image from the buffer
         self.currentImageNum = self.currentImageNum + 1
         self.currentImageNum = np.remainder(self.currentImageNum, self.numLoadedImages)
-        self.currentImage = np.squeeze(self.imageBuffer[:,:,:,self.currentImageNum])
+        self.currentImage = self.frameSource.get_frame(self.currentImageNum)
+        self.frameSource.prefetch(self.currentImageNum + 1)
                 
         self.update_gui()
     
@@ -16,15 +16,162 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import QPalette, QColor, QImage, QPixmap, QPainter, QPen, QGuiApplication
-from PyQt5.QtGui import QPainter, QBrush, QPen, QFont, QFontMetrics
+from PyQt5.QtGui import QPainter, QBrush, QPen, QFont, QFontMetrics, QPainterPath
 
 import numpy as np
-from matplotlib import cm
 import math
 import time
+import threading
+from collections import OrderedDict
 
-import cv2 as cv
+from image_display_colormaps import colormap_colortable
 
+def minmax_decimate(data, numBins):
+    """ Reduces the 1D array `data` to the minimum and maximum of each of 
+    `numBins` equal width bins. Returns a tuple of arrays of (positions, values), 
+    each of length 2 * numBins, giving the minimum and then maximum of each bin, 
+    positioned at the centre of the bin. 
+    """
+    numPoints = np.shape(data)[0]
+    edges = np.linspace(0, numPoints, numBins + 1).astype(int)
+    starts = edges[:-1]
+    
+    values = np.empty(2 * numBins, dtype = np.result_type(data, np.float32))
+    values[0::2] = np.minimum.reduceat(data, starts)
+    values[1::2] = np.maximum.reduceat(data, starts)
+    positions = np.repeat((edges[:-1] + edges[1:] - 1) / 2, 2)
+    return positions, values
+    
+    
+def lttb_decimate(data, numOut):
+    """ Reduces the 1D array `data` to `numOut` points using the 
+    Largest-Triangle-Three-Buckets algorithm, which keeps the points which best
+    preserve the visual shape of the trace. Returns a tuple of arrays of 
+    (positions, values).
+    """
+    numPoints = np.shape(data)[0]
+    if numOut >= numPoints or numOut < 3:
+        return np.arange(numPoints), data
+    
+    # The first and last points are always kept, the remaining points are 
+    # divided into numOut - 2 buckets and one point is chosen from each
+    edges = np.linspace(1, numPoints - 1, numOut - 1).astype(int)
+    starts = edges[:-1]
+    counts = np.diff(edges)
+    bucketMeanX = (edges[:-1] + edges[1:] - 1) / 2
+    bucketMeanY = np.add.reduceat(np.asarray(data, dtype = 'float64'), starts) / counts
+    
+    positions = np.empty(numOut, dtype = int)
+    positions[0] = 0
+    positions[-1] = numPoints - 1
+    prevX, prevY = 0, float(data[0])
+    
+    for i in range(numOut - 2):
+        if i < numOut - 3:
+            nextX, nextY = bucketMeanX[i + 1], bucketMeanY[i + 1]
+        else:
+            nextX, nextY = numPoints - 1, float(data[-1])
+        x = np.arange(edges[i], edges[i + 1])
+        y = data[edges[i]:edges[i + 1]]
+        area = np.abs((prevX - nextX) * (y - prevY) - (prevX - x) * (nextY - prevY))
+        best = edges[i] + int(np.argmax(area))
+        positions[i + 1] = best
+        prevX, prevY = best, float(data[best])
+        
+    return positions, data[positions]
+
+
+def downsample_2x(img):
+    """ Returns a copy of the 2D or 3D (colour) image `img` reduced to half 
+    the size by taking the mean of each 2 x 2 block of pixels, keeping the 
+    data type. An odd last row or column is dropped. The image is processed 
+    in blocks of rows to limit the size of temporary arrays.
+    """
+    h, w = np.shape(img)[0] // 2, np.shape(img)[1] // 2
+    out = np.empty((h, w) + np.shape(img)[2:], dtype = img.dtype)
+    isInteger = np.issubdtype(img.dtype, np.integer)
+    
+    # Sum in a type large enough to hold four pixels
+    if isInteger and img.dtype.itemsize <= 4:
+        sumType = np.dtype(img.dtype.kind + str(2 * img.dtype.itemsize))
+    elif isInteger:
+        sumType = np.int64
+    else:
+        sumType = np.result_type(img.dtype, np.float32)
+        
+    blockRows = max(1, 2**22 // max(w, 1))
+    for start in range(0, h, blockRows):
+        end = min(start + blockRows, h)
+        block = img[2 * start: 2 * end, 0: 2 * w]
+        total = block[0::2, 0::2].astype(sumType)
+        total += block[1::2, 0::2]
+        total += block[0::2, 1::2]
+        total += block[1::2, 1::2]
+        if isInteger:
+            out[start:end] = (total + 2) // 4
+        else:    
+            out[start:end] = total * 0.25
+    return out
+    
+
+def path_from_points(x, y, isMove):
+    """ Builds a QPainterPath from 1D arrays of x and y co-ordinates in one
+    step. Each point starts a new subpath where `isMove` is True and is joined
+    to the previous point by a line otherwise. The elements are written as a
+    serialised path and read using a QDataStream, which is much faster than 
+    calling moveTo and lineTo for each point.
+    """
+    numPoints = np.size(x)
+    elements = np.empty(numPoints, dtype = [('type', '>i4'), ('x', '>f8'), ('y', '>f8')])
+    elements['type'] = np.logical_not(isMove)    # 0 is MoveTo, 1 is LineTo
+    elements['x'] = x
+    elements['y'] = y
+    
+    # Number of elements, the elements, then the current subpath start and
+    # the fill rule (1 = winding, so overlapping filled shapes are all filled)
+    data = (np.array([numPoints], dtype = '>i4').tobytes() + elements.tobytes() 
+            + np.array([0, 1], dtype = '>i4').tobytes())
+    path = QPainterPath()
+    stream = QDataStream(QByteArray(data))
+    stream >> path
+    return path
+
+
+def overlay_hit_test(overlayType, x, y, w, h, pointX, pointY, tolerance):
+    """ Tests whether the point (pointX, pointY) is within `tolerance` of 
+    overlays with positions x, y and sizes w, h. overlayType is either one of 
+    ImageDisplay.ELLIPSE, RECTANGLE, POINT or LINE, or an array of these, one 
+    for each overlay. Returns a boolean array. Rectangles and ellipses are hit 
+    anywhere inside, lines and points only close to them.
+    """
+    x, y, w, h = (np.asarray(v, dtype = 'float64') for v in (x, y, w, h))
+    overlayType = np.broadcast_to(overlayType, np.shape(x))
+    hit = np.zeros(np.shape(x), dtype = bool)
+    
+    # Rectangles
+    hit |= ((overlayType == ImageDisplay.RECTANGLE)
+           & (pointX >= np.minimum(x, x + w) - tolerance) & (pointX <= np.maximum(x, x + w) + tolerance)
+           & (pointY >= np.minimum(y, y + h) - tolerance) & (pointY <= np.maximum(y, y + h) + tolerance))
+           
+    # Ellipses
+    radiusX = np.abs(w) / 2 + tolerance
+    radiusY = np.abs(h) / 2 + tolerance
+    hit |= ((overlayType == ImageDisplay.ELLIPSE)
+           & (((pointX - x - w / 2) / radiusX)**2 + ((pointY - y - h / 2) / radiusY)**2 <= 1))
+    
+    # Points
+    hit |= ((overlayType == ImageDisplay.POINT) 
+           & (np.abs(pointX - x) <= tolerance) & (np.abs(pointY - y) <= tolerance))
+    
+    # Lines, using the distance to the closest point on the segment
+    length2 = w**2 + h**2
+    t = np.clip(((pointX - x) * w + (pointY - y) * h) / np.where(length2 > 0, length2, 1), 0, 1)
+    hit |= ((overlayType == ImageDisplay.LINE)
+           & ((pointX - x - t * w)**2 + (pointY - y - t * h)**2 <= tolerance**2))
+    
+    return hit
+
+    
 class ImageDisplay(QLabel):
     
    ELLIPSE = 0
@@ -38,6 +185,17 @@ class ImageDisplay(QLabel):
    GRAPH = 2
     
    mouseMoved = pyqtSignal(int, int)
+   
+   # Emitted with a PerformanceStats object each time the performance
+   # statistics are updated
+   performanceUpdated = pyqtSignal(object)
+   
+   # Emitted (possibly from another thread) when submit_frame receives a
+   # frame and no update of the display is already scheduled
+   _frameSubmitted = pyqtSignal()
+   
+   # Emitted with the frame index when a frame from the frame source is shown
+   frameChanged = pyqtSignal(int)
 
    imageSize = (0,0)
    
@@ -50,7 +208,21 @@ class ImageDisplay(QLabel):
    
    panning = False
    zoomLocation = None
-   pmap = None
+   viewSize = None
+   smoothScaling = False
+   sourceRect = None
+   usePyramid = False
+   pyramid = None
+   pyramidKey = None
+   useTiles = False
+   tileSize = 256
+   tileCacheSize = 256
+   colormapVersion = 0
+   useReadOnlyView = False
+   frameSource = None
+   frameIndex = 0
+   playbackDirection = 1
+   playbackLoop = True
    dragging = False
    dragToX = None
    dragToY = None
@@ -65,6 +237,12 @@ class ImageDisplay(QLabel):
    displayMax = 255
    zoomLevel = 0
    zoomStepDivider = 2   
+   
+   resizeDelay = 50
+   image = None
+   viewportFirst = True
+   statsSampleSize = 2**18
+   autoScalePercentiles = None
     
    zoomIndicatorPen = QPen(Qt.white, 1, Qt.SolidLine)
    zoomIndicatorBrush = QBrush(Qt.white, Qt.SolidPattern)
@@ -82,6 +260,10 @@ class ImageDisplay(QLabel):
    statusTextPen = QPen(Qt.black, 2, Qt.SolidLine)
    
    graphPen = QPen(Qt.white, 1, Qt.SolidLine)
+   graphTracePens = [QPen(Qt.yellow, 1, Qt.SolidLine), QPen(Qt.cyan, 1, Qt.SolidLine),
+                     QPen(Qt.magenta, 1, Qt.SolidLine), QPen(Qt.green, 1, Qt.SolidLine),
+                     QPen(Qt.red, 1, Qt.SolidLine), QPen(QColor(255, 128, 0), 1, Qt.SolidLine)]
+   graphPens = None
    graphCursorBrush = QBrush(Qt.white, Qt.SolidPattern)
    graphCursorPen = QPen(Qt.white, 2, Qt.SolidLine)
    graphCursorSize = 4
@@ -89,16 +271,48 @@ class ImageDisplay(QLabel):
    graphZeroPen = QPen(Qt.white, 1, Qt.DotLine)
    graphDisplayMin = None
    graphDisplayMax = None
+   graphDecimation = 'minmax'
+   graphDecimated = None
+   graphVersion = 0
+   graphData = None
+   graphTraces = []
+   graphRing = None
+   graphBlockSize = 1024
+   graphStats = None
    
    imageMode = MONO
    
    overlays = []
    nOverlays = 0
+   overlayVersion = 0
+   overlayIndex = None
+   overlayIndexVersion = None
+   overlayCullMargin = 16
+   useOverlayCache = True
+   overlayLayer = None
+   overlayLayerKey = None
    
    colortable = None
+   frameStats = {}
+   roiStats = None
+   integralImages = None
+   useIntegralImage = True
+   displayGamma = 1.0
+   rgbLinkedScale = True
+   maxLuts = 8
+   frameVersion = 0
+   frameDisplayRange = (0, 255)
+   mappedFrame = None
+   mappedFrameKey = None
+   lutBlockSize = 65536
    roi = None
    
    lastFrameTime = 0
+   framePainted = True
+   unpaintedFrames = 0
+   isPerformanceOverlay = False
+   performanceInterval = 1.0
+   performancePen = QPen(Qt.yellow, 1, Qt.SolidLine)
    
    
    def __init__(self, **kwargs):
@@ -111,6 +325,34 @@ class ImageDisplay(QLabel):
        self.setCursor(Qt.CrossCursor)    
        self.mouseX = 0
        self.mouseY = 0
+       self.buffers = {}
+       self.polygons = {}
+       self.luts = {}
+       self.overlays = []
+       self.tileCache = OrderedDict()
+       
+       # Latest-frame-wins buffer used by submit_frame
+       self._frameLock = threading.Lock()
+       self._pendingFrame = None
+       self._frameUpdateScheduled = False
+       self.droppedFrames = 0
+       
+       # Counters used for performance statistics
+       self.perfFrames = 0
+       self.perfPaints = 0
+       self.perfDropped = 0
+       self.perfTimes = {}
+       self.perfIntervalStart = time.perf_counter()
+       self.performanceStats = PerformanceStats()
+       
+       self._frameSubmitted.connect(self._process_pending_frame, Qt.QueuedConnection)
+       
+       self.resizeTimer = QTimer()
+       self.resizeTimer.setSingleShot(True)
+       self.resizeTimer.timeout.connect(self.handle_resize)
+       
+       self.playbackTimer = QTimer()
+       self.playbackTimer.timeout.connect(self.next_frame)
        
        self.set_image(np.zeros((20,20)))      
        #self.setSizePolicy(QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.MinimumExpanding,  QtWidgets.QSizePolicy.MinimumExpanding))
@@ -135,7 +377,7 @@ class ImageDisplay(QLabel):
    def mouseMoveEvent(self, event):
        """ Record mouse positions and update status bar  """  
 
-       if self.pmap is not None:
+       if self.viewSize is not None:
            
            self.mouseX, self.mouseY = self.image_coords(event.x(), event.y()) 
            #print(f"Mouse Moved to: {event.x()}, {event.y()} : {self.mouseX}, {self.mouseY}")
@@ -151,7 +393,7 @@ class ImageDisplay(QLabel):
               self.displayY = min(max(self.displayY - moveY,0), h - self.displayH)
               self.panningX, self.panningY = self.image_coords(event.x(), event.y())
 
-              self.set_image(self.currentImage)
+              self.update_view()
          
            if self.is_mouse_on_image():
                closestX,closestY = self.image_coords_closest(event.x(), event.y()) #self.mouseMoved.emit(self.mouseX, self.mouseY)
@@ -198,7 +440,7 @@ class ImageDisplay(QLabel):
            self.zoomLocation = (self.mouseX, self.mouseY)           
            self.zoomLevel = self.zoomLevel + round(event.angleDelta().y() / 120) / self.zoomStepDivider
            self.zoomLevel = max(self.zoomLevel, 0)
-           self.set_image(self.currentImage)
+           self.update_view()
   
            
    def is_mouse_on_image(self):
@@ -214,17 +456,305 @@ class ImageDisplay(QLabel):
        
         
    def set_graph(self, graph):
+       """ Sets the data to be displayed as a line graph. `graph` is either a 1D
+       numpy array, a 2D numpy array with one trace in each row, or a list of
+       1D arrays. Each trace is drawn with its own pen, see set_graph_pens.
+       """
        self.graphData = graph       
+       if isinstance(graph, np.ndarray) and graph.ndim == 1:
+           self.graphTraces = [graph]
+       else:
+           self.graphTraces = [np.asarray(trace).ravel() for trace in graph]
+       self.graphRing = None
+       self.graphVersion = self.graphVersion + 1
        
+       self.set_graph_canvas()
+
+
+   def set_graph_canvas(self):
+       """ Sets up the blank image on which graphs are drawn.
+       """
        img = np.zeros((self.graph_width, self.graph_height))
        self.set_image(img)
        
        self.imageMode = self.GRAPH
        self.zoomLevel = 0
-
-
-
        
+       # The graph canvas is never tiled
+       if self.useTiles:
+           self.set_display_buffer(self.map_view())
+       
+       
+   def set_graph_buffer(self, capacity, numTraces = 1):
+       """ Switches to a scrolling strip chart graph showing the most recent
+       `capacity` samples of each of `numTraces` traces, added using 
+       append_graph_samples. The samples are stored in a fixed size ring 
+       buffer, so adding samples does not reallocate or copy the existing 
+       samples.
+       """
+       self.graphRing = np.zeros((numTraces, capacity))
+       self.graphRingPos = 0
+       self.graphRingCount = 0
+       
+       # The minimum, maximum and sum of each block of samples are kept up
+       # to date as samples are added, so the graph range can be found without
+       # scanning the whole buffer
+       numBlocks = math.ceil(capacity / self.graphBlockSize)
+       self.graphBlockMin = np.full(numBlocks, np.inf)
+       self.graphBlockMax = np.full(numBlocks, -np.inf)
+       self.graphBlockSum = np.zeros(numBlocks)
+       
+       self.graphData = self.graphRing
+       self.graphTraces = list(self.graphRing)
+       self.graphVersion = self.graphVersion + 1
+       self.set_graph_canvas()
+       
+       
+   def append_graph_samples(self, samples):
+       """ Adds samples to the end of the strip chart graph created using 
+       set_graph_buffer. `samples` is a 1D array for a single trace, or a 2D 
+       array with one row for each trace. The oldest samples are discarded 
+       once the buffer is full.
+       """
+       if self.graphRing is None:
+           raise ValueError("set_graph_buffer must be called before append_graph_samples")
+           
+       numTraces, capacity = self.graphRing.shape    
+       samples = np.asarray(samples).reshape(numTraces, -1)
+       if samples.shape[1] > capacity:
+           samples = samples[:, -capacity:]
+       numSamples = samples.shape[1]
+       if numSamples == 0:
+           return
+       
+       # Copy in, in two parts if we wrap around the end of the buffer
+       start = self.graphRingPos
+       firstPart = min(numSamples, capacity - start)
+       self.graphRing[:, start:start + firstPart] = samples[:, :firstPart]
+       self.graphRing[:, :numSamples - firstPart] = samples[:, firstPart:]
+       
+       self.graphRingPos = (start + numSamples) % capacity
+       self.graphRingCount = min(self.graphRingCount + numSamples, capacity)
+       
+       # Update block statistics only for blocks we have written to
+       block = self.graphBlockSize
+       touched = set(range(start // block, (start + firstPart - 1) // block + 1))
+       if firstPart < numSamples:
+           touched.update(range(0, (numSamples - firstPart - 1) // block + 1))
+       for b in touched:
+           values = self.graphRing[:, b * block : min((b + 1) * block, self.graphRingCount)]
+           if values.size > 0:
+               self.graphBlockMin[b] = np.min(values)
+               self.graphBlockMax[b] = np.max(values)
+               self.graphBlockSum[b] = np.sum(values)
+       
+       self.graphVersion = self.graphVersion + 1
+       self.update()
+       
+       
+   def graph_length(self):
+       """ Returns the number of samples spanned by the horizontal axis of the 
+       graph, i.e. the length of the longest trace. For a strip chart this is 
+       the buffer capacity.
+       """
+       if self.graphData is None or len(self.graphTraces) == 0:
+           return 0
+       return max(len(trace) for trace in self.graphTraces)
+   
+   
+   def graph_segments(self, trace = 0):
+       """ Returns a list of tuples of (position, samples) which make up trace
+       number `trace` of the current graph in order, where position is the 
+       horizontal position of the first sample. A strip chart which has 
+       wrapped around its buffer has two segments, which are views into the 
+       buffer rather than copies.
+       """
+       if self.graphRing is None:
+           return [(0, self.graphTraces[trace])]
+       
+       ring = self.graphRing[trace]
+       count = self.graphRingCount
+       if count < len(ring):
+           return [(0, ring[:count])]
+       
+       pos = self.graphRingPos
+       segments = [(0, ring[pos:])]
+       if pos > 0:
+           segments.append((len(ring) - pos, ring[:pos]))
+       return segments
+   
+   
+   def graph_value(self, position):
+       """ Returns a list of the value of each trace at horizontal `position`. 
+       The value is None for traces with no sample there.
+       """
+       values = []
+       for trace in self.graphTraces:
+           if position < 0 or position >= len(trace):
+               values.append(None)
+           elif self.graphRing is None:
+               values.append(trace[position])
+           elif self.graphRingCount < len(trace):
+               if position >= self.graphRingCount:
+                   values.append(None)
+               else:
+                   values.append(trace[position])
+           else:
+               values.append(trace[(self.graphRingPos + position) % len(trace)])
+       return values        
+           
+       
+   def decimated_graph(self, numColumns):
+       """ Returns a list, with one entry for each trace of the current graph,
+       of tuples of arrays of (sample positions, values) to draw, on a display 
+       `numColumns` pixels wide. If a trace has more than twice as many 
+       points as columns, it is reduced using the method in graphDecimation, 
+       'minmax' (default) or 'lttb', otherwise all the points are returned. 
+       The result is cached until the graph or the number of columns changes.
+       """
+       numPoints = self.graph_length()
+       key = (self.graphVersion, numColumns, self.graphDecimation)
+       if self.graphDecimated is None or self.graphDecimated[0] != key:
+           decimated = []
+           for trace in range(len(self.graphTraces)):
+               xs = []
+               ys = []
+               for position, data in self.graph_segments(trace):
+                   
+                   # Each segment gets a share of the columns matching its length
+                   segmentColumns = max(1, int(round(numColumns * len(data) / numPoints)))
+                   if self.graphDecimation is None or len(data) <= 2 * segmentColumns:
+                       x, y = np.arange(len(data)), data
+                   elif self.graphDecimation == 'lttb':
+                       x, y = lttb_decimate(data, 2 * segmentColumns)
+                   else:
+                       x, y = minmax_decimate(data, segmentColumns)
+                   xs.append(x + position)
+                   ys.append(y)
+               if len(xs) == 1:
+                   decimated.append((xs[0], ys[0]))
+               else:
+                   decimated.append((np.concatenate(xs), np.concatenate(ys)))
+           self.graphDecimated = (key, decimated)
+       return self.graphDecimated[1]
+   
+   
+   def graph_stats(self):
+       """ Returns a tuple of (min, max, mean) over all traces of the current 
+       graph. These are computed once each time the graph is set. For a strip 
+       chart they are found from the block statistics updated by 
+       append_graph_samples.
+       """
+       if self.graphStats is None or self.graphStats[0] != self.graphVersion:
+           if self.graphRing is not None:
+               if self.graphRingCount > 0:
+                   stats = (float(np.min(self.graphBlockMin)), float(np.max(self.graphBlockMax)), float(np.sum(self.graphBlockSum)) / (self.graphRingCount * len(self.graphRing)))
+               else:
+                   stats = (0.0, 0.0, 0.0)
+           else:
+               traces = [trace for trace in self.graphTraces if len(trace) > 0]
+               total = sum(float(np.sum(trace)) for trace in traces)
+               count = sum(len(trace) for trace in traces)
+               stats = (min(float(np.min(trace)) for trace in traces), max(float(np.max(trace)) for trace in traces), total / count)
+           self.graphStats = (self.graphVersion, stats)
+       return self.graphStats[1]
+   
+   
+   def graph_pen(self, trace):
+       """ Returns the QPen used to draw trace number `trace`. If graphPens has
+       been set using set_graph_pens, these are used in turn. Otherwise the
+       first trace uses graphPen and the others use graphTracePens in turn.
+       """
+       if self.graphPens:
+           return self.graphPens[trace % len(self.graphPens)]
+       if trace == 0:
+           return self.graphPen
+       return self.graphTracePens[(trace - 1) % len(self.graphTracePens)]
+   
+   
+   def set_graph_pens(self, pens):
+       """ Sets the QPens used to draw each graph trace. `pens` is a list, 
+       if there are more traces than pens, the pens are reused in turn. Pass
+       None to use the default pens.
+       """
+       self.graphPens = pens
+       self.update()
+       
+       
+   def set_graph_decimation(self, method):
+       """ Sets how graphs with many more points than horizontal screen pixels 
+       are reduced before drawing. 'minmax' (default) draws the minimum and 
+       maximum of the points falling in each pixel column, so no peaks are
+       lost. 'lttb' uses the Largest-Triangle-Three-Buckets algorithm. None
+       draws every point.
+       """
+       self.graphDecimation = method
+       self.graphDecimated = None
+       self.update()
+       
+       
+   def set_frame_source(self, frameSource):
+       """ Sets the frame source (from image_display_sources) to display frames
+       from, and shows the first frame. Pass None to remove the frame source.
+       """
+       self.stop()
+       self.frameSource = frameSource
+       self.frameIndex = 0
+       if frameSource is not None and frameSource.num_frames() > 0:
+           self.show_frame(0)
+   
+   
+   def show_frame(self, index):
+       """ Displays frame `index` of the frame source, and starts reading the
+       following frames in the direction of playback in the background.
+       """
+       if self.frameSource is None:
+           return
+       index = min(max(int(index), 0), self.frameSource.num_frames() - 1)
+       frame = self.frameSource.get_frame(index)
+       self.frameIndex = index
+       self.frameSource.prefetch(index + self.playbackDirection, self.playbackDirection, self.playbackLoop)
+       self.set_image(frame)
+       self.frameChanged.emit(index)
+       
+       
+   def next_frame(self):
+       """ Displays the next frame of the frame source in the direction of 
+       playback. At the end of the frames, playback either loops or stops.
+       """
+       if self.frameSource is None:
+           return
+       numFrames = self.frameSource.num_frames()
+       index = self.frameIndex + self.playbackDirection
+       if index < 0 or index >= numFrames:
+           if self.playbackLoop:
+               index = index % numFrames
+           else:
+               self.stop()
+               return
+       self.show_frame(index)
+       
+       
+   def play(self, fps = 25, direction = 1, loop = True):
+       """ Plays the frame source at `fps` frames per second, forwards if 
+       `direction` is 1 or backwards if -1. If `loop` is True playback 
+       continues from the start once the end is reached, otherwise it stops.
+       """
+       self.playbackDirection = direction
+       self.playbackLoop = loop
+       self.playbackTimer.start(max(int(round(1000 / fps)), 1))
+       
+       
+   def stop(self):
+       """ Stops playback of the frame source.
+       """
+       self.playbackTimer.stop()
+       
+       
+   def is_playing(self):
+       """ Returns True if the frame source is being played.
+       """
+       return self.playbackTimer.isActive()
        
        
    def set_image(self,img):
@@ -239,6 +769,87 @@ class ImageDisplay(QLabel):
            self.set_mono_image(img)
            
            
+   def submit_frame(self, img):
+       """ Submits the image `img` for display. Unlike set_image, this can be
+       called from any thread. Only the most recently submitted frame is kept, 
+       the conversion for display is carried out later in the GUI thread, at 
+       most once per repaint. If several frames are submitted before the 
+       display is updated, all but the newest are dropped and counted in 
+       droppedFrames. The array should not be modified after it has been 
+       submitted.
+       """
+       with self._frameLock:
+           if self._pendingFrame is not None:
+               self.droppedFrames = self.droppedFrames + 1
+           self._pendingFrame = img
+           schedule = not self._frameUpdateScheduled
+           self._frameUpdateScheduled = True
+       
+       # Only one update is queued per burst of frames
+       if schedule:
+           self._frameSubmitted.emit()
+       
+       
+   def _process_pending_frame(self):
+       """ Displays the newest frame passed to submit_frame. Runs in the GUI thread.
+       While the widget is visible, no further frame is converted until this 
+       one has been painted, see paintEvent.
+       """
+       with self._frameLock:
+           img = self._pendingFrame
+           self._pendingFrame = None
+           self._frameUpdateScheduled = img is not None and self.isVisible()
+           
+       if img is not None:
+           self.set_image(img)
+           self.update()
+           
+           
+   def _frame_painted(self):
+       """ Called after each paint to schedule conversion of any frame 
+       submitted since the last one was converted.
+       """
+       with self._frameLock:
+           schedule = self._frameUpdateScheduled and self._pendingFrame is not None
+           self._frameUpdateScheduled = schedule
+       if schedule:
+           self._frameSubmitted.emit()
+           
+           
+   def num_dropped_frames(self):
+       """ Returns the number of frames passed to submit_frame which were
+       replaced by a newer frame before they could be displayed.
+       """
+       return self.droppedFrames
+   
+   
+   def reset_dropped_frames(self):
+       """ Resets the count of dropped frames to zero.
+       """
+       with self._frameLock:
+           self.droppedFrames = 0
+           
+           
+   def image_reference(self, img):
+       """ Returns the array to keep as the current image. This is `img` 
+       itself in its own data type, not a copy, or a read-only view of it if 
+       useReadOnlyView is True.
+       """
+       img = np.asarray(img)
+       if self.useReadOnlyView and img.flags.writeable:
+           img = img.view()
+           img.flags.writeable = False
+       return img
+   
+   
+   def get_image(self):
+       """ Returns the current image. This is the array passed to set_image, 
+       or a read-only view of it if set_read_only_view_enabled(True) has been 
+       called.
+       """
+       return self.currentImage
+   
+   
    def set_mono_image(self, img):
        """ Sets a grayscale image as the current image """
        
@@ -256,41 +867,61 @@ class ImageDisplay(QLabel):
        
        
        
-       self.currentImage = img
+       self.currentImage = self.image_reference(img)
+       self.frameStats = {}
+       self.roiStats = None
+       self.integralImages = None
+       self.frameVersion = self.frameVersion + 1
+       self.frame_received()
        self.imageMode = self.MONO
        self.imageSize = np.shape(img)
+       self.map_current_image()
+       
+       
+   def map_current_image(self):
+       """ Maps the current image for display using the current display 
+       settings. Called when a new image is set, and by refresh when only the 
+       display settings have changed. frameVersion is not changed, so the 
+       image pyramid, statistics and integral images are kept.
+       """
+       img = self.currentImage
        if img is not None and np.size(img) > 0:           
            
            t1 = time.perf_counter()
-           if self.autoScale: #and np.max(img) != 0:
-               img = img.astype('float32')
-               img = img - np.min(img)
-               m = np.max(img)
-               if m > 0:
-                   sf =  255 / m
-               else:
-                   sf = 0
-               img = img * sf
-              
-               #img = cv.normalize(img,0,255,cv.NORM_MINMAX)           
-            
-           img = img.astype('uint8')
            
-           self.displayImage = self.zoom(img)          
-            
-           self.image = QtGui.QImage(self.displayImage.copy(), self.displayImage.shape[1], self.displayImage.shape[0], self.displayImage.shape[1], QtGui.QImage.Format_Indexed8)
-                      
-           # Set colormap
-           if self.colortable is not None:
-               self.image.setColorTable(self.colortable)
+           if self.autoScale and self.imageMode == self.RGB: 
+               self.frameDisplayRange = self.rgb_autoscale_range(img)
+           elif self.autoScale:
+               self.frameDisplayRange = self.autoscale_range(img)
+           elif self.imageMode == self.RGB:    
+               self.frameDisplayRange = (self.displayMin, self.displayMax)
+           else:
+               
+               # A range set for each colour channel is reduced to a single
+               # range covering all channels for monochrome images
+               self.frameDisplayRange = (float(np.min(self.displayMin)), float(np.max(self.displayMax)))
+               
+           # In viewport-first mode we crop to the zoomed region before
+           # mapping, so only pixels which will be displayed are processed.
+           # Otherwise the whole image is mapped, and kept for panning and zooming
+           if self.useTiles:
+               self.update_tiled_view()
+               return
+           elif self.viewportFirst or self.usePyramid:
+               region = self.map_view()
+               self.record_time('mapping', t1)
+           else:
+               region = self.mapped_frame()
+               self.record_time('mapping', t1)
+               t2 = time.perf_counter()
+               region = self.zoom(region)
+               self.record_time('zoom', t2)
            
-           scaledSize = QtCore.QSize(self.geometry().width(), self.geometry().height()-40)
-           self.pmap = QtGui.QPixmap.fromImage(self.image).scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
-           self.setPixmap(self.pmap)
+           self.set_display_buffer(region)
       
        else:
 
-           self.pmap = None
+           self.viewSize = None
 
 
    def set_rgb_image(self, img):
@@ -310,41 +941,523 @@ class ImageDisplay(QLabel):
        self.imageHeight = np.shape(img)[0]    
        
        
-       self.currentImage = img.astype(float)       
+       self.currentImage = self.image_reference(img)
+       self.frameStats = {}
+       self.roiStats = None
+       self.integralImages = None
+       self.frameVersion = self.frameVersion + 1
+       self.frame_received()
        self.imageMode = self.RGB       
        self.imageSize = np.shape(img)
-
+       self.map_current_image()
+       
+       
+   def map_view(self):
+       """ Returns the part of the current image which is in view, mapped to 8 
+       bit for display. Only these pixels are processed. If the image pyramid
+       is enabled, they are taken from the smallest level of the pyramid which 
+       still has at least one pixel per screen pixel, and sourceRect is set to 
+       the part of the returned region which is in view.
+       """
+       t1 = time.perf_counter()
+       self.sourceRect = None
+       region = self.zoom(self.currentImage)
+       level = self.view_pyramid_level()
+       if level > 0:
+           region = self.pyramid_region(level)
+       self.record_time('zoom', t1)
+       
+       return self.map_to_display(region, *self.frameDisplayRange, out = self.display_buffer('display', region))
+       
        
-       if img is not None and np.size(img) > 0:
+   def view_pyramid_level(self):
+       """ Returns the level of the image pyramid to display the current view 
+       from. This is the smallest level which still has at least one pixel per
+       screen pixel, or 0 (the full image) if neither the pyramid nor tiles 
+       are enabled.
+       """
+       if not (self.usePyramid or self.useTiles) or self.imageMode == self.GRAPH:
+           return 0
+       ratio = self.devicePixelRatioF()
+       screenW = max(self.width() * ratio, 1)
+       screenH = max((self.height() - 40) * ratio, 1)
+       pixelsPerScreenPixel = max(self.displayW / screenW, self.displayH / screenH)
+       if pixelsPerScreenPixel < 2:
+           return 0
+       level = int(math.floor(math.log2(pixelsPerScreenPixel)))
+       maxLevel = int(math.floor(math.log2(max(min(self.imageWidth, self.imageHeight), 1))))
+       return min(level, maxLevel)
+   
+   
+   def pyramid_level(self, level):
+       """ Returns level `level` of the image pyramid of the current image, 
+       where level 0 is the image itself and each level is half the size of 
+       the previous one. Levels are built when first needed and are kept until
+       the image changes.
+       """
+       if self.pyramidKey != self.frameVersion or self.pyramid is None:
+           self.pyramid = [self.currentImage]
+           self.pyramidKey = self.frameVersion
+       while len(self.pyramid) <= level:
+           t1 = time.perf_counter()
+           self.pyramid.append(downsample_2x(self.pyramid[-1]))
+           self.record_time('pyramid', t1)
+       return self.pyramid[level]
+       
+   
+   def pyramid_region(self, level):
+       """ Returns the region of pyramid level `level` which covers the current
+       view (displayX, displayY, displayW, displayH), and sets sourceRect to
+       the (fractional) part of this region which is exactly in view.
+       """
+       img = self.pyramid_level(level)
+       scale = 2**level
+       x1, y1 = int(self.displayX // scale), int(self.displayY // scale)
+       x2 = min(int(math.ceil((self.displayX + self.displayW) / scale)), np.shape(img)[1])
+       y2 = min(int(math.ceil((self.displayY + self.displayH) / scale)), np.shape(img)[0])
+       self.sourceRect = QRectF(self.displayX / scale - x1, self.displayY / scale - y1, 
+                                self.displayW / scale, self.displayH / scale)
+       return img[y1:y2, x1:x2]
            
-           # img = img.astype('float')
+       
+   def update_tiled_view(self):
+       """ In tiled mode, updates the position and size of the view. The 
+       tiles in view are mapped for display when the widget is painted.
+       """
+       t1 = time.perf_counter()
+       self.zoom(self.currentImage)
+       self.record_time('zoom', t1)
+       self.update_view_size()
+       
+       
+   def get_tile(self, level, tileX, tileY):
+       """ Returns a QImage of the tile at column tileX and row tileY of level
+       `level` of the image pyramid, mapped for display. Tiles are kept in a 
+       least recently used cache of up to tileCacheSize tiles, so only tiles 
+       which have not been shown with the current image and display settings
+       are mapped.
+       """
+       key = (level, tileX, tileY, self.tileSize, self.frameVersion, self.imageMode, 
+              self.frameDisplayRange, self.displayGamma, self.colormapVersion)
+       if key in self.tileCache:
+           self.tileCache.move_to_end(key)
+           return self.tileCache[key][0]
+       
+       img = self.pyramid_level(level)
+       size = self.tileSize
+       region = img[tileY * size: (tileY + 1) * size, tileX * size: (tileX + 1) * size]
+       tile = np.ascontiguousarray(self.map_to_display(region, *self.frameDisplayRange))
+       if tile.ndim > 2:
+           imageFormat = QtGui.QImage.Format_RGBX8888 if tile.shape[2] == 4 else QtGui.QImage.Format_RGB888
+       else:
+           if self.colortable is not None:
+               imageFormat = QtGui.QImage.Format_Indexed8
+           else:
+               imageFormat = QtGui.QImage.Format_Grayscale8
+       
+       image = QtGui.QImage(tile.data, tile.shape[1], tile.shape[0], tile.strides[0], imageFormat)
+       if imageFormat == QtGui.QImage.Format_Indexed8:
+           image.setColorTable(self.colortable)
            
-           # if self.autoScale and np.max(img) != 0:
-           #     img = img - np.min(img)
-           #     img = (img / np.max(img) * 255)
-           # else:
-           #     img = img - self.displayMin
-           #     img = (img / self.displayMax * 255)
+       # The array is kept with the QImage, which does not copy it
+       self.tileCache[key] = (image, tile)
+       while len(self.tileCache) > self.tileCacheSize:
+           self.tileCache.popitem(last = False)
+       return image
+   
+   
+   def draw_tiles(self, painter):
+       """ Draws the tiles which are in view, from the smallest level of the
+       image pyramid which has at least one pixel per screen pixel.
+       """
+       level = self.view_pyramid_level()
+       scale = 2**level
+       img = self.pyramid_level(level)
+       size = self.tileSize
+       
+       firstX = int(self.displayX // scale) // size
+       firstY = int(self.displayY // scale) // size
+       lastX = min(int(math.ceil((self.displayX + self.displayW) / scale)), np.shape(img)[1] - 1) // size
+       lastY = min(int(math.ceil((self.displayY + self.displayH) / scale)), np.shape(img)[0] - 1) // size
+       
+       xOffset, yOffset = self.screen_offsets()
+       xScale = self.viewSize.width() / self.displayW * scale
+       yScale = self.viewSize.height() / self.displayH * scale
+       for tileY in range(firstY, lastY + 1):
+           for tileX in range(firstX, lastX + 1):
+               tile = self.get_tile(level, tileX, tileY)
+               target = QRectF((tileX * size - self.displayX / scale) * xScale + xOffset, 
+                               (tileY * size - self.displayY / scale) * yScale + yOffset,
+                               tile.width() * xScale, tile.height() * yScale)
+               painter.drawImage(target, tile, QRectF(tile.rect()))
+               
+       
+   def mapped_frame(self):
+       """ Returns the whole of the current image mapped to 8 bit for display. 
+       This is cached, so it is only computed once per frame and display 
+       range. Panning and zooming then only require the mapped frame to be 
+       cropped.
+       """
+       key = (self.frameVersion, self.imageMode, self.frameDisplayRange, self.displayGamma)
+       if self.mappedFrameKey != key:
+           img = self.currentImage
+           self.mappedFrame = self.map_to_display(img, *self.frameDisplayRange, out = self.display_buffer('mapped', img))
+           self.mappedFrameKey = key
+       return self.mappedFrame
+   
+   
+   def update_view(self):
+       """ Updates the display after the zoom or pan has changed, by cropping 
+       the cached mapped frame rather than processing the image again.
+       """
+       if self.imageMode != self.GRAPH and self.currentImage is not None and np.size(self.currentImage) > 0:
+           if self.useTiles:
+               self.update_tiled_view()
+               self.update()
+               return
+           elif self.usePyramid:
+               t1 = time.perf_counter()
+               region = self.map_view()
+               self.record_time('mapping', t1)
+               self.set_display_buffer(region)
+               self.update()
+               return
+           t1 = time.perf_counter()
+           region = self.mapped_frame()
+           self.record_time('mapping', t1)
+           t1 = time.perf_counter()
+           region = self.zoom(region)
+           self.record_time('zoom', t1)
+           self.set_display_buffer(region)
+       self.update()    
+       
+       
+   def autoscale_range(self, img):
+       """ Returns a tuple of (lower, upper) pixel values used to autoscale
+       `img`. For images larger than statsSampleSize pixels these are estimated 
+       from a strided subsample of the image, so the range does not depend on 
+       which part of the image is being displayed. If autoScalePercentiles is 
+       set, the range is given by these percentiles of the subsample rather
+       than the minimum and maximum.
+       """
+       h, w = img.shape[0:2]
+       step = max(1, math.ceil(math.sqrt(h * w / self.statsSampleSize)))
+       sample = img[::step, ::step]
+       
+       if self.autoScalePercentiles is None:
+           lower, upper = float(np.min(sample)), float(np.max(sample))
            
-           img = img.astype('uint8')
-
-           imgZoom = self.zoom(img)
+           # If we used every pixel of the current image, the status bar can 
+           # reuse the minimum and maximum
+           if step == 1 and img is self.currentImage:
+               self.frameStats['min'] = lower
+               self.frameStats['max'] = upper
+           return lower, upper
        
-           self.displayImage = np.empty((imgZoom.shape[0], imgZoom.shape[1], 4), np.uint8, 'C')       
-           self.displayImage[...,0] = imgZoom[...,2]
-           self.displayImage[...,1] = imgZoom[...,1]
-           self.displayImage[...,2] = imgZoom[...,0]
-           self.displayImage[...,3].fill(255)
-    
-           self.displayImage2 = self.displayImage.copy()
-           self.image = QtGui.QImage(self.displayImage2.copy(), self.displayImage.shape[1], self.displayImage.shape[0], QtGui.QImage.Format_RGB32)
-           scaledSize = QtCore.QSize(self.geometry().width(), self.geometry().height()-40)
-
-           self.pmap = QtGui.QPixmap.fromImage(self.image).scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
-    
-           self.setPixmap(self.pmap)
+       if sample.dtype == np.uint8 or sample.dtype == np.uint16:
+           # For integer images use a histogram rather than sorting
+           hist = np.bincount(sample.ravel(), minlength = np.iinfo(sample.dtype).max + 1)
+           cumHist = np.cumsum(hist)
+           targets = np.array(self.autoScalePercentiles) / 100 * (cumHist[-1] - 1) 
+           lower, upper = np.searchsorted(cumHist, targets, side = 'right')
+           return float(lower), float(upper)
+       else:
+           lower, upper = np.percentile(sample, self.autoScalePercentiles)
+           return float(lower), float(upper)
+       
+       
+   def rgb_autoscale_range(self, img):
+       """ Returns a tuple of (lower, upper) values used to autoscale the 
+       colour image `img`, each a tuple of one value per channel. If 
+       rgbLinkedScale is True the same range, from all channels, is used for
+       each channel, preserving the colour balance. Otherwise each channel is 
+       scaled separately.
+       """
+       if self.rgbLinkedScale:
+           lower, upper = self.autoscale_range(img[..., 0:3])
+           return (lower,) * 3, (upper,) * 3
+       ranges = [self.autoscale_range(img[..., channel]) for channel in range(3)]
+       return tuple(r[0] for r in ranges), tuple(r[1] for r in ranges)
+       
+       
+   def display_buffer(self, name, img):
+       """ Returns the reusable uint8 array called `name` which `img` is 
+       mapped into for display. Colour images are mapped to 4 bytes per pixel 
+       (red, green, blue and an unused byte), the unused byte is set to 255
+       when the array is allocated.
+       """
+       if img.ndim > 2:
+           return self.get_buffer(name, img.shape[0:2] + (4,), 'uint8', fill = 255)
+       return self.get_buffer(name, img.shape, 'uint8')
+       
+       
+   def map_to_display(self, img, lower, upper, out = None):
+       """ Returns `img` mapped to an 8 bit image for display, such that 
+       `lower` and below maps to 0 and `upper` and above maps to 255, with 
+       displayGamma applied. uint8 and uint16 images are mapped using a look 
+       up table, other types are scaled as floating point. If `out` is provided, 
+       a uint8 array of the same shape as `img`, the result is written into it.
+       Colour images are mapped by map_rgb_to_display.
+       """
+       if img.ndim > 2:
+           return self.map_rgb_to_display(img, lower, upper, out)
+       
+       if img.dtype == np.uint8 and lower == 0 and upper == 255 and self.displayGamma == 1:
+           if out is None:
+               return img
+           out[...] = img
+           return out
+       
+       if out is None:
+           out = np.empty(img.shape, np.uint8)
+           
+       if img.dtype == np.uint8 or img.dtype == np.uint16:
+           lut = self.display_lut(img.dtype, lower, upper)
+           
+           # The gather is done in blocks of rows, this avoids numpy creating 
+           # a full size temporary array of indices and is several times faster
+           step = max(1, self.lutBlockSize // max(1, img.shape[1]))
+           for row in range(0, img.shape[0], step):
+               np.take(lut, img[row:row + step], out = out[row:row + step], mode = 'clip')
+           return out
+       
+       if upper > lower:
+           sf = 255 / (upper - lower)
+       else:
+           sf = 0
+       work = self.get_buffer('float', img.shape, 'float32')
+       np.subtract(img, lower, out = work, casting = 'unsafe')
+       work *= sf
+       np.clip(work, 0, 255, out = work)
+       if self.displayGamma != 1:
+           self.apply_gamma(work)
+       np.copyto(out, work, casting = 'unsafe')
+       return out
+   
+   
+   def map_rgb_to_display(self, img, lower, upper, out = None):
+       """ Returns the colour image `img` (height, width, channels) mapped for
+       display as a uint8 array of shape (height, width, 4) of red, green, 
+       blue and an unused byte, suitable for a 32 bit QImage. lower and upper 
+       are either single values or tuples of one value per channel. uint8 
+       and uint16 images are mapped with a look up table per channel, other 
+       types are scaled as floating point in blocks of rows using a reused 
+       work buffer. Each channel is written directly into `out` if provided, 
+       the unused byte of `out` is not written and should already be 255 (see
+       display_buffer). uint8 images which do not need mapping are returned 
+       unchanged (as height, width, 3) without copying.
+       """
+       lower = np.broadcast_to(np.asarray(lower, dtype = 'float64'), (3,))
+       upper = np.broadcast_to(np.asarray(upper, dtype = 'float64'), (3,))
+       if img.dtype == np.uint8 and np.all(lower == 0) and np.all(upper == 255) and self.displayGamma == 1:
+           return img[..., 0:3]
+       
+       h, w = img.shape[0:2]
+       if out is None:
+           out = np.full((h, w, 4), 255, np.uint8)
+           
+       step = max(1, self.lutBlockSize // max(1, w))
+           
+       if img.dtype == np.uint8 or img.dtype == np.uint16:
+           for channel in range(3):
+               lut = self.display_lut(img.dtype, lower[channel], upper[channel])
+               for row in range(0, h, step):
+                   np.take(lut, img[row:row + step, :, channel], out = out[row:row + step, :, channel], mode = 'clip')
+           return out
+       
+       scale = np.where(upper > lower, 255 / np.where(upper > lower, upper - lower, 1), 0).astype('float32')
+       offset = lower.astype('float32')
+       work = self.get_buffer('rgbWork', (min(step, h), w, 3), 'float32')
+       for row in range(0, h, step):
+           block = work[:min(step, h - row)]
+           np.subtract(img[row:row + step, :, 0:3], offset, out = block, casting = 'unsafe')
+           block *= scale
+           np.clip(block, 0, 255, out = block)
+           if self.displayGamma != 1:
+               self.apply_gamma(block)
+           np.copyto(out[row:row + step, :, 0:3], block, casting = 'unsafe')
+       return out
+   
+   
+   def apply_gamma(self, work):
+       """ Applies displayGamma in place to the float32 array `work` of values
+       from 0 to 255.
+       """
+       work *= 1 / 255
+       np.power(work, self.displayGamma, out = work)
+       work *= 255
+   
+   
+   def get_buffer(self, name, shape, dtype, fill = None):
+       """ Returns a reusable working array called `name`. A new array is only
+       allocated if the shape or type differs from the last time it was requested,
+       and is filled with `fill` if this is not None.
+       """
+       buffer = self.buffers.get(name)
+       if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+           if fill is None:
+               buffer = np.empty(shape, dtype)
+           else:
+               buffer = np.full(shape, fill, dtype)
+           self.buffers[name] = buffer
+       return buffer
        
        
+   def display_lut(self, dtype, lower, upper):
+       """ Returns a look up table mapping every possible value of the 
+       integer type `dtype` (uint8 or uint16) to an 8 bit display value. 
+       Tables are cached for each type, range and gamma, so the tables for 
+       each channel of colour images are not rebuilt every frame. Colormaps
+       are applied afterwards by the QImage colour table, so do not require 
+       the table to be rebuilt.
+       """
+       key = (np.dtype(dtype).str, float(lower), float(upper), self.displayGamma)
+       if key not in self.luts:
+           if len(self.luts) >= self.maxLuts:
+               self.luts.clear()
+           values = np.arange(np.iinfo(dtype).max + 1, dtype = 'float32')
+           self.luts[key] = self.map_to_display(values, lower, upper)
+       return self.luts[key]
+   
+   
+   def frame_stats(self):
+       """ Returns a tuple of (min, max, mean) pixel values of the current image.
+       These are computed at most once per frame.
+       """
+       stats = self.frameStats
+       if 'min' not in stats:
+           stats['min'] = float(np.min(self.currentImage))
+       if 'max' not in stats:
+           stats['max'] = float(np.max(self.currentImage))
+       if 'mean' not in stats:
+           stats['mean'] = float(np.mean(self.currentImage))
+       return stats['min'], stats['max'], stats['mean']
+   
+   
+   def roi_stats(self):
+       """ Returns a tuple of (min, max, mean, standard deviation) of pixel 
+       values within the current ROI. These are computed directly from the ROI
+       pixels, at most once per frame or change of ROI.
+       """
+       if self.roiStats is None or self.roiStats[0] != self.roi:
+           roi = self.currentImage[self.roi[1] : self.roi[3], self.roi[0]: self.roi[2],...]
+           roiMean, roiStd = float(np.mean(roi)), float(np.std(roi))
+           self.roiStats = (self.roi, (float(np.min(roi)), float(np.max(roi)), roiMean, roiStd))
+       return self.roiStats[1]
+   
+   
+   def integral_images(self):
+       """ Returns a tuple of the integral image (summed area table) of the 
+       current image and the integral image of the squared pixel values. For 
+       colour images the channels are summed. Each has one more row and column 
+       than the image, with the first row and column zero. They are built 
+       the first time they are requested for each frame.
+       """
+       if self.integralImages is None:
+           img = self.currentImage
+           
+           # Integer images of up to 16 bits are summed exactly using int64, 
+           # others as float64 since the sum of squares of wider integer 
+           # types can overflow int64
+           if (np.issubdtype(img.dtype, np.integer) and img.dtype.itemsize <= 2) or img.dtype == np.bool_:
+               sumType = 'int64'
+           else:
+               sumType = 'float64'
+           img = img.astype(sumType)
+           sq = img * img
+           if img.ndim > 2:
+               img = np.sum(img, axis = 2)
+               sq = np.sum(sq, axis = 2)
+               
+           h, w = img.shape    
+           sat = np.zeros((h + 1, w + 1), sumType)
+           sat2 = np.zeros((h + 1, w + 1), sumType)
+           np.cumsum(img, axis = 0, out = sat[1:, 1:])
+           np.cumsum(sat[1:, 1:], axis = 1, out = sat[1:, 1:])
+           np.cumsum(sq, axis = 0, out = sat2[1:, 1:])
+           np.cumsum(sat2[1:, 1:], axis = 1, out = sat2[1:, 1:])
+           self.integralImages = (sat, sat2)
+       return self.integralImages    
+   
+   
+   def region_mean_std(self, x1, y1, x2, y2):
+       """ Returns a tuple of the (mean, standard deviation) of the pixel values 
+       of the current image in the rectangle from (x1, y1) up to but 
+       not including (x2, y2). Uses the integral images so the cost does not 
+       depend on the size of the rectangle. Returns (None, None) if the 
+       rectangle contains no pixels.
+       """
+       h, w = self.currentImage.shape[0:2]
+       x1, x2 = min(max(int(x1), 0), w), min(max(int(x2), 0), w)
+       y1, y2 = min(max(int(y1), 0), h), min(max(int(y2), 0), h)
+       if x2 <= x1 or y2 <= y1:
+           return None, None
+       
+       sat, sat2 = self.integral_images()
+       n = (x2 - x1) * (y2 - y1)
+       if self.currentImage.ndim > 2:
+           n = n * self.currentImage.shape[2]
+       total = float(sat[y2, x2] - sat[y1, x2] - sat[y2, x1] + sat[y1, x1])
+       totalSq = float(sat2[y2, x2] - sat2[y1, x2] - sat2[y2, x1] + sat2[y1, x1])
+       mean = total / n
+       std = math.sqrt(max(totalSq / n - mean ** 2, 0))
+       return mean, std
+   
+       
+   def refresh(self):
+       """ Redisplays the current image, for example after the display settings
+       have been changed. The image itself is assumed not to have changed, so 
+       the image pyramid and statistics are kept; call set_image if the 
+       pixel values have been modified.
+       """
+       if self.imageMode != self.GRAPH and self.currentImage is not None:
+           self.map_current_image()
+       self.update()
+       
+       
+   def set_display_buffer(self, displayImage):
+       """ Wraps the uint8 array `displayImage` as a QImage without copying 
+       and updates the size of the image on screen. A 2D array is displayed as a monochrome image 
+       using the current colormap, a 3D array as an RGB image (with 4 channels, 
+       as red, green, blue and an unused byte). The array is only 
+       copied if it is not contiguous. A reference to the array is kept in 
+       displayImage for as long as the QImage is in use.
+       """
+       t1 = time.perf_counter()
+       if displayImage.ndim > 2 and displayImage.shape[2] != 4:
+           displayImage = displayImage[..., 0:3]
+       displayImage = np.ascontiguousarray(displayImage)
+       h, w = displayImage.shape[0:2]
+       
+       if displayImage.ndim > 2 and displayImage.shape[2] == 4:
+           imageFormat = QtGui.QImage.Format_RGBX8888
+       elif displayImage.ndim > 2:
+           imageFormat = QtGui.QImage.Format_RGB888
+       elif self.colortable is not None:
+           imageFormat = QtGui.QImage.Format_Indexed8
+       else:
+           imageFormat = QtGui.QImage.Format_Grayscale8
+           
+       self.displayImage = displayImage
+       self.image = QtGui.QImage(displayImage.data, w, h, displayImage.strides[0], imageFormat)
+       
+       # Set colormap
+       if imageFormat == QtGui.QImage.Format_Indexed8:
+           self.image.setColorTable(self.colortable)
+       self.record_time('qimage', t1)
+       
+       self.update_view_size()
+       
+       
+   def update_view_size(self):
+       """ Calculates the size on screen of the current view when scaled to
+       fit the widget. The image itself is scaled when it is painted.
+       """
+       if self.currentImage is None:
+           return
+       scaledSize = QtCore.QSize(self.geometry().width(), self.geometry().height()-40)
+       self.viewSize = QtCore.QSize(self.displayW, self.displayH).scaled(scaledSize, QtCore.Qt.KeepAspectRatio)
+       
        
    def zoom(self, img):
         """ Returns a zoomed version of the image for display.
@@ -408,61 +1521,121 @@ class ImageDisplay(QLabel):
     
    
    def resizeEvent(self, new):
-            """ Redraw if resized """
-            self.set_image(self.currentImage)
+       """ Redraw if resized. A burst of resize events, such as when a window
+       is being dragged, is handled by a single rescale once no further events
+       have been received for resizeDelay ms. Until then the image is shown 
+       at its previous size.
+       """
+       if self.resizeDelay > 0:
+           self.resizeTimer.start(self.resizeDelay)
+       else:
+           self.handle_resize()
+           
+           
+   def handle_resize(self):
+       """ Rescales the display to the current widget size, without mapping the
+       image again unless zoomed in or using an image pyramid. 
+       """
+       if self.imageMode != self.GRAPH and self.isZoomEnabled and self.zoomLevel > 0:
+           
+           # The zoomed region depends on the widget aspect ratio, so crop again
+           self.update_view()
+       elif self.imageMode != self.GRAPH and self.usePyramid:
+           
+           # The pyramid level depends on the widget size
+           self.update_view()
+       else:
+           self.update_view_size()
+           self.update()
        
       
    def screen_coords(self, x, y):
        """ Convert image co-ordinates to screen co-ordinates """
-       if self.currentImage is None or self.pmap is None:
+       if self.currentImage is None or self.viewSize is None:
            return None, None
        else:
            xOffset, yOffset = self.screen_offsets()
-           screenX = round((x - self.displayX) * (self.pmap.width()) / np.shape(self.displayImage)[1] + xOffset)
-           screenY = round((y - self.displayY) * (self.pmap.height()) / np.shape(self.displayImage)[0] + yOffset)
+           screenX = round((x - self.displayX) * (self.viewSize.width()) / self.displayW + xOffset)
+           screenY = round((y - self.displayY) * (self.viewSize.height()) / self.displayH + yOffset)
            return screenX, screenY
        
        
+   def screen_coords_array(self, x, y, out = None):
+       """ Convert arrays of image co-ordinates to screen co-ordinates. Returns
+       an array of shape (n, 2) of x and y screen co-ordinates. Unlike 
+       screen_coords, these are not rounded. If `out` is provided the result 
+       is written into it.
+       """
+       xOffset, yOffset = self.screen_offsets()
+       xScale = self.viewSize.width() / self.displayW
+       yScale = self.viewSize.height() / self.displayH
+       if out is None:
+           out = np.empty((np.size(x), 2))
+       np.subtract(x, self.displayX, out = out[:,0])
+       out[:,0] *= xScale
+       out[:,0] += xOffset
+       np.subtract(y, self.displayY, out = out[:,1])
+       out[:,1] *= yScale
+       out[:,1] += yOffset
+       return out
+       
+   
    def image_coords(self, x, y):
        """ Convert screen co-ordinates to floor image co-ordinates """    
 
-       if self.currentImage is None or self.pmap is None:
+       if self.currentImage is None or self.viewSize is None:
            return None, None
        else:
            xOffset, yOffset = self.screen_offsets()
-           imageX = math.floor( (x - xOffset) / (self.pmap.width()) * np.shape(self.displayImage)[1] + self.displayX)
-           imageY = math.floor( (y - yOffset) / (self.pmap.height()) * np.shape(self.displayImage)[0] + self.displayY)
+           imageX = math.floor( (x - xOffset) / (self.viewSize.width()) * self.displayW + self.displayX)
+           imageY = math.floor( (y - yOffset) / (self.viewSize.height()) * self.displayH + self.displayY)
            return imageX, imageY
    
         
    def image_coords_closest(self, x, y):
        """ Convert screen co-ordinates to cloest image co-ordinates """    
 
-       if self.currentImage is None or self.pmap is None:
+       if self.currentImage is None or self.viewSize is None:
            return None, None
        else:
            xOffset, yOffset = self.screen_offsets()
-           imageX = round( (x - xOffset) / (self.pmap.width()) * np.shape(self.displayImage)[1] + self.displayX)
-           imageY = round( (y - yOffset) / (self.pmap.height()) * np.shape(self.displayImage)[0] + self.displayY)
+           imageX = round( (x - xOffset) / (self.viewSize.width()) * self.displayW + self.displayX)
+           imageY = round( (y - yOffset) / (self.viewSize.height()) * self.displayH + self.displayY)
            return int(imageX), int(imageY)
        
   
+   def get_polygon(self, name, n):
+       """ Returns a tuple of a reusable QPolygonF called `name` with `n` points, 
+       and a writable numpy array of shape (n, 2) which shares memory with the 
+       polygon's x and y co-ordinates. A new polygon is only created if the 
+       number of points changes.
+       """
+       polygon, points = self.polygons.get(name, (None, None))
+       if polygon is None or polygon.size() != n:
+           polygon = QtGui.QPolygonF(n)
+           ptr = polygon.data()
+           ptr.setsize(n * 2 * np.dtype(np.float64).itemsize)
+           points = np.frombuffer(ptr, np.float64).reshape(n, 2)
+           self.polygons[name] = (polygon, points)
+       return polygon, points
+   
+   
    def screen_offsets(self):  
            """ Returns the x and y co-ordinates of the top left of the image relative to Widget"""
-           xOffset = (self.width() - self.pmap.width())/ 2 
-           yOffset = (self.height() - self.pmap.height())/ 2 
+           xOffset = (self.width() - self.viewSize.width())/ 2 
+           yOffset = (self.height() - self.viewSize.height())/ 2 
            return int(xOffset), int(yOffset)
        
        
    def screen_size(self):  
            """ Returns the width and height of the view window in screen pixels"""
-           return self.pmap.width(), self.pmap.height()
+           return self.viewSize.width(), self.viewSize.height()
        
            
    def screen_dims(self, x,y):       
            """ Convert image dimensions to screen dimensions """
-           screenX = round(x * (self.pmap.width()) / np.shape(self.displayImage)[1])
-           screenY = round(y * (self.pmap.height()) / np.shape(self.displayImage)[0])               
+           screenX = round(x * (self.viewSize.width()) / self.displayW)
+           screenY = round(y * (self.viewSize.height()) / self.displayH)               
            return int(screenX), int(screenY)
        
         
@@ -472,24 +1645,49 @@ class ImageDisplay(QLabel):
 
        super().paintEvent(event)
        self.draw()
+       self._frame_painted()
+
 
+   def hideEvent(self, event):
+       """ Frames submitted while hidden are converted without waiting for a
+       paint.
+       """
+       super().hideEvent(event)
+       self._frame_painted()
+       
 
    def draw(self):
        """ This is where the whole thing is drawn"""       
 
        self.lastFrameTime = time.perf_counter()
+       self.framePainted = True
+       self.perfPaints = self.perfPaints + 1
        painter = QPainter(self)
        
        # Prevent drawing outside of image
        painter.setClipRect(QRect(*self.screen_offsets(), *self.screen_size() ))
+       
+       # The image is scaled to the screen as it is drawn, rather than 
+       # creating a scaled copy each time the image changes
+       t1 = time.perf_counter()
+       painter.setRenderHint(QPainter.SmoothPixmapTransform, self.smoothScaling)
+       if self.useTiles and self.imageMode != self.GRAPH:
+           self.draw_tiles(painter)
+       else:    
+           if self.sourceRect is None:
+               sourceRect = QRectF(self.image.rect())
+           else:
+               sourceRect = self.sourceRect
+           painter.drawImage(QRectF(*self.screen_offsets(), *self.screen_size()), self.image, sourceRect)
+       self.record_time('paint_image', t1)
 
        if self.imageMode == self.GRAPH:
 
-           if self.graphData is not None:
-               num_points = np.shape(self.graphData)[0]  
+           graphMin, graphMax = 0, 1
+           num_points = self.graph_length()
+           if num_points > 0:
                  
-               max_val = np.max(self.graphData)
-               min_val = np.min(self.graphData)
+               min_val, max_val, mean_val = self.graph_stats()
                
                if self.graphDisplayMin is None:
                    graphMin = min_val
@@ -500,16 +1698,38 @@ class ImageDisplay(QLabel):
                    graphMax = max_val
                else:
                    graphMax = self.graphDisplayMax
-               plotX = np.linspace(0, self.graph_width, num_points)
-               plotY = self.graph_height - (self.graphData - graphMin) / ( graphMax - graphMin) * self.graph_height
-              
-               painter.setPen(self.graphPen)
-
-               for i in range(num_points - 1):
+               if graphMax == graphMin:
+                   graphScale = 0
+               else:
+                   graphScale = self.graph_height / (graphMax - graphMin)
+               
+               # If there are many more points than screen pixels, draw
+               # a reduced version of the graph
+               traces = self.decimated_graph(self.screen_size()[0])
+               lengths = [len(sampleX) for sampleX, sampleY in traces]
+               
+               # Transform all points of all traces to screen co-ordinates at 
+               # once, writing directly into a QPolygonF
+               polygon, points = self.get_polygon('graph', sum(lengths))
+               if len(traces) == 1:
+                   sampleX, sampleY = traces[0]
+               else:    
+                   sampleX = np.concatenate([x for x, y in traces])
+                   sampleY = np.concatenate([y for x, y in traces])
+               plotX = sampleX * (self.graph_width / max(num_points - 1, 1))
+               plotY = self.graph_height - (sampleY - graphMin) * graphScale
+               self.screen_coords_array(plotX, plotY, out = points)
                
-                   x,y = self.screen_coords(plotX[i],plotY[i])
-                   x2,y2 = self.screen_coords(plotX[i + 1],plotY[i+1])
-                   painter.drawLine(x,y,x2,y2)
+               # Draw each trace as a single polyline
+               start = 0
+               for trace, length in enumerate(lengths):
+                   if length > 0:
+                       painter.setPen(self.graph_pen(trace))
+                       if length == len(points):
+                           painter.drawPolyline(polygon)
+                       else:    
+                           painter.drawPolyline(polygon.mid(start, length))
+                   start = start + length
                    
            font = painter.font()
            fm = QFontMetrics(font)        
@@ -540,26 +1760,14 @@ class ImageDisplay(QLabel):
 
             
        #################### Draw overlays
-       for overlay in self.overlays:
-           
-           painter.setPen(overlay.pen)
-           if overlay.fill is not None:
-               painter.setBrush(overlay.fill)
-           
-           # Convert the image co-ordinates to screen co-ordinates    
-           x,y = self.screen_coords(overlay.x1, overlay.y1)
-           w,h = self.screen_dims(overlay.x2, overlay.y2)
-           
-           if overlay.overlayType == self.ELLIPSE:    
-               painter.drawEllipse(x,y,w,h)
-           elif overlay.overlayType == self.RECTANGLE:
-               painter.drawRect(x,y,w,h)
-           elif overlay.overlayType == self.POINT:
-               painter.drawPoint(x,y)
-           elif overlay.overlayType == self.LINE:
-               painter.drawLine(x,y,x + w,y + h)
-           elif overlay.overlayType == self.TEXT:
-               painter.drawText(x, y, overlay.text)
+       t1 = time.perf_counter()
+       if len(self.overlays) > 0:
+           if self.useOverlayCache:
+               painter.drawImage(0, 0, self.overlay_layer())
+           else:    
+               self.draw_overlays(painter)
+               painter.setBrush(Qt.NoBrush)
+       self.record_time('overlays', t1)        
                
                
        ##################### Draw dragging ROI    
@@ -603,13 +1811,13 @@ class ImageDisplay(QLabel):
            painter.setPen(self.zoomIndicatorPen)
            
            if self.imageHeight < self.imageWidth:
-               x = self.width() - (self.width() - self.pmap.width()) / 2 - self.zoomIndicatorOffsetX - self.zoomIndicatorWidth
-               y = (self.height() - self.pmap.height()) / 2 + self.zoomIndicatorOffsetY
+               x = self.width() - (self.width() - self.viewSize.width()) / 2 - self.zoomIndicatorOffsetX - self.zoomIndicatorWidth
+               y = (self.height() - self.viewSize.height()) / 2 + self.zoomIndicatorOffsetY
                w = self.zoomIndicatorWidth
                h = self.imageSize[0] / self.imageSize[1] * w
            else:
-               x = self.width() - (self.width() - self.pmap.width()) / 2 - self.zoomIndicatorOffsetX 
-               y = (self.height() - self.pmap.height()) / 2 + self.zoomIndicatorOffsetY
+               x = self.width() - (self.width() - self.viewSize.width()) / 2 - self.zoomIndicatorOffsetX 
+               y = (self.height() - self.viewSize.height()) / 2 + self.zoomIndicatorOffsetY
                h = self.zoomIndicatorWidth
                w = self.imageSize[1] / self.imageSize[0] * h
                
@@ -632,7 +1840,8 @@ class ImageDisplay(QLabel):
            
       
        ##################### Draw status bar 
-       if self.isStatusBar and self.pmap is not None:
+       t1 = time.perf_counter()
+       if self.isStatusBar and self.viewSize is not None:
        
            font = painter.font()
            fm = QFontMetrics(font)
@@ -659,19 +1868,21 @@ class ImageDisplay(QLabel):
                cursorVal = '--'
                          
            if self.currentImage is not None:
-               self.meanPixel = str(round(np.mean(self.currentImage),1))
-               self.maxPixel = str(round(np.max(self.currentImage)))
-               self.minPixel = str(round(np.min(self.currentImage)))
+               minPixel, maxPixel, meanPixel = self.frame_stats()
+               self.meanPixel = str(round(meanPixel,1))
+               self.maxPixel = str(round(maxPixel))
+               self.minPixel = str(round(minPixel))
            else:
                self.meanPixel = '-'
                self.maxPixel = '-'
                self.minPixel = '-'
                
            if self.currentImage is not None and self.roi is not None and self.roi is not []:
-               roi = self.currentImage[self.roi[1] : self.roi[3], self.roi[0]: self.roi[2],...]
-               self.roiMax = str(round(np.max(roi)))
-               self.roiMin = str(round(np.min(roi)))
-               self.roiMean = str(round(np.mean(roi),1))               
+               roiMin, roiMax, roiMean, roiStd = self.roi_stats()
+               self.roiMax = str(round(roiMax))
+               self.roiMin = str(round(roiMin))
+               self.roiMean = str(round(roiMean,1))               
+               self.roiStd = str(round(roiStd,1))
            
            if self.zoomLevel > 0:
                text = str(round(2**(self.zoomLevel))) + 'X '
@@ -682,32 +1893,396 @@ class ImageDisplay(QLabel):
                text = text + '(' + mX + ',' + mY + ') = ' + cursorVal + ' | [' + self.minPixel + '-' + self.maxPixel + ', Mean: ' + self.meanPixel + ']'
            
                if self.roi is not None:
-                   text = text + ' | [ROI: (' + str(self.roi[0] ) + ',' + str(self.roi[1]) + ')-(' + str(self.roi[2] -1) + '-' + str(self.roi[3] -1) + '): ' + self.roiMin + '-' + self.roiMax + ', Mean: ' + self.roiMean + ']' 
+                   text = text + ' | [ROI: (' + str(self.roi[0] ) + ',' + str(self.roi[1]) + ')-(' + str(self.roi[2] -1) + '-' + str(self.roi[3] -1) + '): ' + self.roiMin + '-' + self.roiMax + ', Mean: ' + self.roiMean + ', SD: ' + self.roiStd + ']' 
             
                elif self.dragging and self.dragX != self.dragToX and self.dragY != self.dragToY:
-                   text = text + ' | [Dragging ROI: (' + str(dragRoi[0]) + ',' + str(dragRoi[1] ) + ')-(' + str(dragRoi[2] -1) + '-' + str(dragRoi[3] -1) + ') ]'
+                   text = text + ' | [Dragging ROI: (' + str(dragRoi[0]) + ',' + str(dragRoi[1] ) + ')-(' + str(dragRoi[2] -1) + '-' + str(dragRoi[3] -1) + ')'
+                   
+                   # Live statistics are only cheap enough if we have integral images
+                   if self.useIntegralImage:
+                       dragMean, dragStd = self.region_mean_std(*dragRoi)
+                       if dragMean is not None:
+                           text = text + ': Mean: ' + str(round(dragMean,1)) + ', SD: ' + str(round(dragStd,1))
+                   text = text + ' ]'
            else: #GRAPH
-               if self.mouseX is not None and self.mouseY is not None:
-                   xP =  str(round(int(self.mouseX / self.graph_width * num_points) ))
-                   yP =  str(round(self.graphData[int(self.mouseX / self.graph_width * num_points) ],3))
+               if self.mouseX is not None and self.mouseY is not None and num_points > 0:
+                   position = int(self.mouseX / self.graph_width * num_points)
+                   values = self.graph_value(position)
+                   xP =  str(position)
+                   yP = ','.join('-' if value is None else str(round(value,3)) for value in values)
     
                    prec = 3
-                   text = text + '(' + xP + ',' + yP + ') | [' + str(round(np.min(self.graphData),prec)) + ' -> ' + str(round(np.max(self.graphData),prec)) + ', Mean: ' + str(round(np.mean(self.graphData),prec)) + ']'
+                   text = text + '(' + xP + ',' + yP + ') | [' + str(round(min_val,prec)) + ' -> ' + str(round(max_val,prec)) + ', Mean: ' + str(round(mean_val,prec)) + ']'
                     
-                   x,y = self.screen_coords(self.mouseX,plotY[int(self.mouseX* num_points / self.graph_width)])
                    painter.setBrush(self.graphCursorBrush)
                    painter.setPen(self.graphCursorPen)
-                   painter.drawEllipse(x-self.graphCursorSize,y -self.graphCursorSize, self.graphCursorSize * 2,self.graphCursorSize *2)
+                   for value in values:
+                       if value is not None:
+                           cursorY = self.graph_height - (value - graphMin) * graphScale
+                           x,y = self.screen_coords(self.mouseX, cursorY)
+                           painter.drawEllipse(x-self.graphCursorSize,y -self.graphCursorSize, self.graphCursorSize * 2,self.graphCursorSize *2)
 
 
 
-           xPos = int(round((self.width() - self.pmap.width()) /2))
+           xPos = int(round((self.width() - self.viewSize.width()) /2))
            painter.setBrush(self.statusBrush)
            painter.setPen(self.statusPen)
-           painter.drawRect(int(xPos + 1), int(self.height() - fm.height() - 5), int(self.pmap.width() - 2), int(fm.height() + 4))
+           painter.drawRect(int(xPos + 1), int(self.height() - fm.height() - 5), int(self.viewSize.width() - 2), int(fm.height() + 4))
            painter.setPen(self.statusTextPen)
            painter.drawText(int(xPos + 10), int(self.height() - 6), text)
+           self.record_time('status', t1)
           
+       ##################### Draw performance readout
+       if self.isPerformanceOverlay and self.viewSize is not None:
+           stats = self.performanceStats
+           text = 'In: ' + str(round(stats.inputFps, 1)) + ' fps | Paint: ' + str(round(stats.paintFps, 1)) + ' fps | Not painted: ' + str(stats.droppedFrames + stats.unpaintedFrames)
+           stageText = ' | '.join(stage + ': ' + str(round(ms, 2)) + ' ms' for stage, ms in stats.stageTimes.items())
+           fm = QFontMetrics(painter.font())
+           xOffset, yOffset = self.screen_offsets()
+           painter.setPen(self.performancePen)
+           painter.drawText(xOffset + 10, yOffset + fm.height() + 4, text)
+           painter.drawText(xOffset + 10, yOffset + 2 * fm.height() + 6, stageText)
+          
+       self.update_performance_stats()    
+       
+       
+   def draw_overlays(self, painter):
+       """ Draws the overlays within the current view using `painter`.
+       """
+       viewRect = self.visible_image_rect(self.overlayCullMargin)
+       isVisible = self.visible_overlays(viewRect)
+       for overlay, visible in zip(self.overlays, isVisible):
+           
+           if not visible:
+               continue
+           
+           if isinstance(overlay, OverlayCollection):
+               self.draw_overlay_collection(painter, overlay, viewRect)
+               continue
+           
+           painter.setPen(overlay.pen)
+           if overlay.fill is not None:
+               painter.setBrush(overlay.fill)
+           else:
+               painter.setBrush(Qt.NoBrush)
+           
+           # Convert the image co-ordinates to screen co-ordinates    
+           x,y = self.screen_coords(overlay.x1, overlay.y1)
+           w,h = self.screen_dims(overlay.x2, overlay.y2)
+           
+           if overlay.overlayType == self.ELLIPSE:    
+               painter.drawEllipse(x,y,w,h)
+           elif overlay.overlayType == self.RECTANGLE:
+               painter.drawRect(x,y,w,h)
+           elif overlay.overlayType == self.POINT:
+               painter.drawPoint(x,y)
+           elif overlay.overlayType == self.LINE:
+               painter.drawLine(x,y,x + w,y + h)
+           elif overlay.overlayType == self.TEXT:
+               painter.drawText(x, y, overlay.text)
+       
+       
+   def overlay_layer(self):
+       """ Returns a transparent QImage the size of the widget with the
+       overlays drawn on it. This is only redrawn when the overlays change or 
+       the view (zoom, pan or size) changes, so that repainting the widget 
+       for other reasons, such as moving the mouse, does not redraw them.
+       """
+       key = (self.overlayVersion, tuple(overlay.version for overlay in self.overlays 
+                                         if isinstance(overlay, OverlayCollection)),
+              self.displayX, self.displayY, self.displayW, self.displayH,
+              self.screen_size(), self.width(), self.height(), self.devicePixelRatioF())
+       if self.overlayLayer is None or key != self.overlayLayerKey:
+           t1 = time.perf_counter()
+           ratio = self.devicePixelRatioF()
+           layer = self.overlayLayer
+           size = QSize(int(round(self.width() * ratio)), int(round(self.height() * ratio)))
+           if layer is None or layer.size() != size:
+               layer = QImage(size, QImage.Format_ARGB32_Premultiplied)
+               layer.setDevicePixelRatio(ratio)
+           layer.fill(Qt.transparent)
+           painter = QPainter(layer)
+           painter.setFont(self.font())
+           painter.setClipRect(QRect(*self.screen_offsets(), *self.screen_size()))
+           self.draw_overlays(painter)
+           painter.end()
+           self.overlayLayer = layer
+           self.overlayLayerKey = key
+           self.record_time('overlay_layer', t1)
+       return self.overlayLayer
+   
+   
+   def draw_overlay_collection(self, painter, collection, viewRect = None):
+       """ Draws the elements of an OverlayCollection. If `viewRect` is
+       given as (x1, y1, x2, y2) in image pixels, only elements intersecting 
+       it are drawn. Positions and sizes are converted to screen co-ordinates 
+       in one step and elements sharing a style are drawn with a single 
+       painter call.
+       """
+       if collection.num_elements() == 0:
+           return
+       
+       xScale, yScale = (self.viewSize.width() / self.displayW, 
+                         self.viewSize.height() / self.displayH)
+       
+       x, y, w, h, styles = collection.x, collection.y, collection.w, collection.h, collection.styles
+       if viewRect is not None:
+           visible = collection.spatial_index().query(*viewRect)
+           if visible is not None:
+               x, y, w, h = x[visible], y[visible], w[visible], h[visible]
+               if styles is not None:
+                   styles = styles[visible]
+       numElements = np.size(x)
+       if numElements == 0:
+           return
+       
+       if styles is None:
+           order = None
+           groups = [(0, 0, numElements)]
+       else:
+           # Sort the elements by style so each style is a contiguous block
+           order = np.argsort(styles, kind = 'stable')
+           sortedStyles = styles[order]
+           uniqueStyles = np.unique(sortedStyles)
+           starts = np.searchsorted(sortedStyles, uniqueStyles, side = 'left')
+           ends = np.searchsorted(sortedStyles, uniqueStyles, side = 'right')
+           groups = zip(uniqueStyles, starts, ends)
+       
+       if order is not None:
+           x, y, w, h = x[order], y[order], w[order], h[order]
+       
+       if collection.overlayType == self.POINT:
+           polygon, points = self.get_polygon('overlayPoints', numElements)
+           self.screen_coords_array(x, y, out = points)
+       else:
+           points = self.screen_coords_array(x, y)
+           w = w * xScale
+           h = h * yScale
+       
+       for style, start, end in groups:
+           painter.setPen(collection.pen(style))
+           fill = collection.fill(style)
+           if fill is None:
+               painter.setBrush(Qt.NoBrush)
+           else:    
+               painter.setBrush(fill)
+           
+           if collection.overlayType == self.POINT:
+               if end - start == numElements:
+                   painter.drawPoints(polygon)
+               else:    
+                   painter.drawPoints(polygon.mid(start, end - start))
+           else:
+               painter.drawPath(self.overlay_collection_path(collection.overlayType, 
+                                points[start:end, 0], points[start:end, 1], 
+                                w[start:end], h[start:end]))
+       painter.setBrush(Qt.NoBrush)
+           
+           
+   def visible_image_rect(self, margin = 0):
+       """ Returns the region of the image currently in view as (x1, y1, x2, y2)
+       in image pixels, extended on each side by `margin` screen pixels.
+       """
+       viewH, viewW = self.displayH, self.displayW
+       marginX = margin * viewW / max(self.viewSize.width(), 1)
+       marginY = margin * viewH / max(self.viewSize.height(), 1)
+       return (self.displayX - marginX, self.displayY - marginY,
+               self.displayX + viewW + marginX, self.displayY + viewH + marginY)
+   
+   
+   def overlay_spatial_index(self):
+       """ Returns a tuple of an OverlayIndex of the individual (non-text)
+       overlays, which is rebuilt only when the overlays have changed, and an 
+       array of the position in the list of overlays of each indexed overlay.
+       """
+       if self.overlayIndexVersion != self.overlayVersion or self.overlayIndex is None:
+           positions = [i for i, overlay in enumerate(self.overlays) 
+                        if isinstance(overlay, Overlay) and overlay.overlayType != self.TEXT]
+           overlayType = np.array([self.overlays[i].overlayType for i in positions], dtype = int)
+           x = np.array([self.overlays[i].x1 for i in positions], dtype = 'float64')
+           y = np.array([self.overlays[i].y1 for i in positions], dtype = 'float64')
+           w = np.array([self.overlays[i].x2 for i in positions], dtype = 'float64')
+           h = np.array([self.overlays[i].y2 for i in positions], dtype = 'float64')
+           w[overlayType == self.POINT] = 0
+           h[overlayType == self.POINT] = 0
+           index = OverlayIndex(np.minimum(x, x + w), np.minimum(y, y + h), 
+                                np.maximum(x, x + w), np.maximum(y, y + h))
+           index.overlayType, index.x, index.y, index.w, index.h = overlayType, x, y, w, h 
+           self.overlayIndex = (index, np.array(positions, dtype = int))
+           self.overlayIndexVersion = self.overlayVersion
+       return self.overlayIndex
+       
+       
+   def visible_overlays(self, viewRect):
+       """ Returns a boolean array, one for each overlay, which is False for 
+       individual overlays entirely outside viewRect (x1, y1, x2, y2) in image
+       pixels. Collections and text overlays are always True, collections are
+       culled element by element when drawn.
+       """
+       isVisible = np.ones(len(self.overlays), dtype = bool)
+       index, positions = self.overlay_spatial_index()
+       visible = index.query(*viewRect)
+       if visible is not None:
+           isVisible[positions] = False
+           isVisible[positions[visible]] = True
+       return isVisible
+       
+   
+   def overlay_at(self, x, y, tolerance = 3):
+       """ Returns the top-most overlay at image co-ordinates (x, y), as a 
+       tuple of (overlay, index). For an OverlayCollection, index is the index
+       of the element hit, otherwise it is None. Lines and points are hit if 
+       they are within `tolerance` screen pixels. Text overlays are ignored.
+       Returns (None, None) if there is no overlay at this position.
+       """
+       if self.viewSize is None or len(self.overlays) == 0:
+           return None, None
+       tolerance = tolerance * self.displayW / max(self.viewSize.width(), 1)
+       searchRect = (x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+       
+       # Best individual overlay, as a position in the list of overlays
+       index, positions = self.overlay_spatial_index()
+       candidates = index.query(*searchRect)
+       if candidates is None:
+           candidates = np.arange(len(positions))
+       hit = overlay_hit_test(index.overlayType[candidates], index.x[candidates], index.y[candidates], 
+                              index.w[candidates], index.h[candidates], x, y, tolerance)
+       bestPosition = positions[candidates[hit]].max() if np.any(hit) else -1
+       
+       # Collections after this in the list are drawn on top of it
+       for position in range(len(self.overlays) - 1, bestPosition, -1):
+           collection = self.overlays[position]
+           if not isinstance(collection, OverlayCollection) or collection.num_elements() == 0:
+               continue
+           candidates = collection.spatial_index().query(*searchRect)
+           if candidates is None:
+               candidates = np.arange(collection.num_elements())
+           hit = overlay_hit_test(collection.overlayType, collection.x[candidates], collection.y[candidates], 
+                                  collection.w[candidates], collection.h[candidates], x, y, tolerance)
+           if np.any(hit):
+               return collection, int(candidates[hit].max())
+          
+       if bestPosition >= 0:
+           return self.overlays[bestPosition], None
+       return None, None
+           
+   
+   def overlay_collection_path(self, overlayType, x, y, w, h):
+       """ Returns a QPainterPath containing rectangles, ellipses or lines 
+       with top left corners (or start points) x, y and sizes w, h, all in 
+       screen co-ordinates. Ellipses are approximated by polygons with a 
+       number of sides depending on their size on screen, from 8 to 64 in 
+       powers of 2, so that ellipses of similar size are built together.
+       """
+       if overlayType == self.RECTANGLE:
+           pathX = np.stack((x, x + w, x + w, x, x), axis = 1)
+           pathY = np.stack((y, y, y + h, y + h, y), axis = 1)
+       elif overlayType == self.LINE:
+           pathX = np.stack((x, x + w), axis = 1)
+           pathY = np.stack((y, y + h), axis = 1)
+       elif overlayType == self.ELLIPSE:
+           x, y, w, h = np.broadcast_arrays(x, y, w, h)
+           size = np.maximum(np.abs(w), np.abs(h))
+           sides = 2 ** np.clip(np.ceil(np.log2(np.maximum(size, 1))), 3, 6).astype(int)
+           pointsX, pointsY, moves = [], [], []
+           for numSides in np.unique(sides):
+               sel = sides == numSides
+               angles = np.linspace(0, 2 * np.pi, numSides + 1)
+               angles[-1] = 0
+               pathX = (x[sel] + w[sel] / 2)[:, None] + (w[sel] / 2)[:, None] * np.cos(angles)
+               pathY = (y[sel] + h[sel] / 2)[:, None] + (h[sel] / 2)[:, None] * np.sin(angles)
+               isMove = np.zeros(np.shape(pathX), dtype = bool)
+               isMove[:, 0] = True
+               pointsX.append(pathX.ravel())
+               pointsY.append(pathY.ravel())
+               moves.append(isMove.ravel())
+           if not pointsX:
+               return QPainterPath()
+           return path_from_points(np.concatenate(pointsX), np.concatenate(pointsY), np.concatenate(moves))
+       else:
+           return QPainterPath()
+       
+       isMove = np.zeros(np.shape(pathX), dtype = bool)
+       isMove[:, 0] = True
+       return path_from_points(pathX.ravel(), pathY.ravel(), isMove.ravel())
+       
+       
+   def frame_received(self):
+       """ Records that a new frame has been set for display, for the 
+       performance statistics.
+       """
+       if not self.framePainted:
+           self.unpaintedFrames = self.unpaintedFrames + 1
+       self.framePainted = False
+       self.perfFrames = self.perfFrames + 1
+       
+       
+   def record_time(self, stage, startTime):
+       """ Adds the time since `startTime` (from time.perf_counter) to the
+       total time spent in the pipeline stage `stage`, for the performance 
+       statistics.
+       """
+       total, count = self.perfTimes.get(stage, (0, 0))
+       self.perfTimes[stage] = (total + time.perf_counter() - startTime, count + 1)
+       
+       
+   def update_performance_stats(self):
+       """ Updates the performance statistics if at least performanceInterval 
+       seconds have passed since they were last updated, and emits 
+       performanceUpdated.
+       """
+       now = time.perf_counter()
+       interval = now - self.perfIntervalStart
+       if interval < self.performanceInterval:
+           return
+       
+       stats = PerformanceStats()
+       with self._frameLock:
+           dropped = self.droppedFrames
+       stats.inputFps = (self.perfFrames + dropped - self.perfDropped) / interval
+       stats.paintFps = self.perfPaints / interval
+       stats.droppedFrames = dropped
+       stats.unpaintedFrames = self.unpaintedFrames
+       stats.stageTimes = {stage: total / count * 1000 for stage, (total, count) in self.perfTimes.items()}
+       self.performanceStats = stats
+       
+       self.perfIntervalStart = now
+       self.perfFrames = 0
+       self.perfPaints = 0
+       self.perfDropped = dropped
+       self.perfTimes = {}
+       self.performanceUpdated.emit(stats)
+       
+       
+   def performance_stats(self):
+       """ Returns a PerformanceStats object with the most recent measurements
+       of the display performance. These are updated every 
+       performanceInterval seconds while the display is being painted.
+       """
+       return self.performanceStats
+   
+   
+   def reset_performance_stats(self):
+       """ Resets the counts of dropped and unpainted frames and the timings
+       used for the performance statistics.
+       """
+       self.reset_dropped_frames()
+       self.unpaintedFrames = 0
+       self.perfDropped = 0
+       self.perfFrames = 0
+       self.perfPaints = 0
+       self.perfTimes = {}
+       self.perfIntervalStart = time.perf_counter()
+       self.performanceStats = PerformanceStats()
+       
+       
+   def set_performance_overlay(self, isPerformanceOverlay):
+       """ Set whether the frame rates, dropped frames and timings of each 
+       stage of the display pipeline are shown on the image (True) or not (False).
+       """
+       self.isPerformanceOverlay = isPerformanceOverlay
+       self.update()
+       
         
         
    def add_overlay(self, overlayType, *args):
@@ -754,15 +2329,49 @@ class ImageDisplay(QLabel):
        if overlayType is not None:
            newOverlay = Overlay(overlayType, x, y, w, h, pen, fill, text)
            self.overlays.append(newOverlay)
+           self.overlayVersion = self.overlayVersion + 1
            return newOverlay
        else:
            return None
        
    
+   def add_overlay_collection(self, overlayType, x, y, w = None, h = None, pen = None, fill = None, styles = None):
+       """ Adds a collection of many overlays of the same type, stored as
+       arrays, which is much faster to draw than adding each as a separate
+       overlay. overlayType can be ELLIPSE, RECTANGLE, POINT or LINE. x and y
+       are arrays of the positions in image pixels, and w and h are arrays 
+       (or single values) of the sizes, not used for POINT. pen and fill are 
+       either a single QPen and QBrush, or lists of them. If lists are given, 
+       styles is an array of the index of the pen and fill to use for each 
+       element. Returns the OverlayCollection, which can be passed to 
+       remove_overlay or update_overlay_collection.
+       """
+       if overlayType not in (self.ELLIPSE, self.RECTANGLE, self.POINT, self.LINE):
+           return None
+       if pen is None:
+           pen = QPen(Qt.green, 1, Qt.SolidLine)
+       newCollection = OverlayCollection(overlayType, pen, fill)
+       newCollection.set_data(x, y, w, h, styles)
+       self.overlays.append(newCollection)
+       self.overlayVersion = self.overlayVersion + 1
+       self.update()
+       return newCollection
+   
+   
+   def update_overlay_collection(self, collection, x, y, w = None, h = None, styles = None):
+       """ Replaces the positions, sizes and styles of the elements of an
+       OverlayCollection, for example with the detections from a new frame.
+       """
+       collection.set_data(x, y, w, h, styles)
+       self.overlayVersion = self.overlayVersion + 1
+       self.update()
+       
+       
    def remove_overlay(self, overlay):
        """ Removes overlay 'overlay' from the list of visible overlays
        """
        self.overlays.remove(overlay)
+       self.overlayVersion = self.overlayVersion + 1
        self.update()
          
            
@@ -770,9 +2379,18 @@ class ImageDisplay(QLabel):
        """ Removes all overlays from the list of visible overlays
        """
        self.overlays = []
+       self.overlayVersion = self.overlayVersion + 1
        self.update()
            
    
+   def update_overlays(self):
+       """ Redraws the overlays. This must be called after changing the 
+       position or size of an existing overlay directly.
+       """
+       self.overlayVersion = self.overlayVersion + 1
+       self.update()
+       
+   
    def num_overlays(self):
        """ Returns the number of overlays in the list of visible overlays
        """
@@ -783,7 +2401,21 @@ class ImageDisplay(QLabel):
        """ Determines whether or not images are brightness/contrast autoscaled to use the full dynamic range. True or False.
        """
        self.autoScale = autoScale
-       self.update()
+       self.refresh()
+       
+       
+   def set_auto_scale_percentiles(self, lower, upper):
+       """ Sets autoscaling to map the `lower` and `upper` percentiles (0 - 100) of
+       the image pixel values to 0 and 255, rather than the minimum and maximum. 
+       This prevents a small number of very bright or dark pixels from 
+       dominating the scaling, for example use (0.1, 99.9). Pass None for both 
+       to return to minimum/maximum scaling.
+       """
+       if lower is None or upper is None:
+           self.autoScalePercentiles = None
+       else:
+           self.autoScalePercentiles = (lower, upper)
+       self.refresh()
        
        
    def set_status_bar(self, isStatusBar):
@@ -799,14 +2431,12 @@ class ImageDisplay(QLabel):
        self.isZoomEnabled = isZoomEnabled
        if not isZoomEnabled:
            self.zoomLevel = 0
-       self.set_image(self.currentImage)
-       self.update()
+       self.update_view()
 
    def set_zoom_indicator_enabled(self, isIndicatorEnabled):
        """ Set whether the zoom indicator is shown (True) or not (False).
        """
        self.isZoomIndicator = isIndicatorEnabled
-       self.set_image(self.currentImage)
        self.update()
        
     
@@ -819,33 +2449,118 @@ class ImageDisplay(QLabel):
        self.update()
          
     
+   def set_integral_image_enabled(self, useIntegralImage):
+       """ Sets whether the mean and standard deviation of a ROI are shown live
+       while it is being dragged, calculated using integral images (True, 
+       default), or not (False). Integral images are only built for frames 
+       displayed while a ROI is being dragged.
+       """
+       self.useIntegralImage = useIntegralImage
+       self.integralImages = None
+       self.roiStats = None
+       self.update()
+       
+       
+   def set_overlay_cache_enabled(self, useOverlayCache):
+       """ Sets whether overlays are drawn once onto a cached transparent 
+       layer which is redrawn only when the overlays or view change (True, 
+       default), or are redrawn every time the widget is painted (False).
+       """
+       self.useOverlayCache = useOverlayCache
+       self.overlayLayer = None
+       self.update()
+       
+       
+   def set_tiled_enabled(self, useTiles):
+       """ Sets whether images are displayed as tiles (True) or as a single
+       image (False, default). In tiled mode, the image is divided into tiles 
+       of tileSize x tileSize pixels, which are mapped for display only when 
+       they come into view and are then cached, so panning only maps newly 
+       visible tiles. Tiles are taken from an image pyramid when zoomed out, 
+       and the maximum size of the widget is not limited.
+       """
+       self.useTiles = useTiles
+       self.tileCache.clear()
+       self.pyramid = None
+       self.sourceRect = None
+       if useTiles:
+           self.setMaximumSize(QWIDGETSIZE_MAX, QWIDGETSIZE_MAX)
+       else:
+           self.setMaximumSize(2048, 2048)
+       if self.imageMode == self.GRAPH:
+           self.update()
+       else:    
+           self.refresh()
+       
+       
+   def set_pyramid_enabled(self, usePyramid):
+       """ Sets whether an image pyramid (copies of the image reduced by 
+       factors of 2, 4, 8 ...) is used when displaying large images (True) or 
+       not (False, default). The view is then taken from the smallest copy 
+       which still has at least one pixel per screen pixel, so that zooming 
+       out on a very large image is as fast as displaying a screen-sized image.
+       Each copy is made when first needed and kept until the image changes.
+       """
+       self.usePyramid = usePyramid
+       self.pyramid = None
+       self.sourceRect = None
+       self.update_view()
+       
+       
+   def set_smooth_scaling(self, smoothScaling):
+       """ Sets whether the image is smoothly interpolated when it is scaled to 
+       the screen (True), or shown with nearest neighbour scaling so that each 
+       image pixel is displayed exactly (False, default).
+       """
+       self.smoothScaling = smoothScaling
+       self.update()
+       
+       
    def set_colormap(self, colormapName):
-       """ Sets the colormap using a matplotlib colormap. Provide the colormap as a string containing the anme of the colormap.
+       """ Sets the colormap. Provide the colormap as a string containing the name of the colormap,
+       or None for no colormap. Common colormaps such as 'gray', 'viridis', 'inferno' and 'hsv' are 
+       built in, any other matplotlib colormap can be used if matplotlib is installed.
        """
 
        if colormapName is None:
            self.colortable = None
        else:   
-           colormap = cm.get_cmap(colormapName) 
-           colormap._init()
-           lut = (colormap._lut * 255).view(np.ndarray).astype('int16')  # Convert matplotlib colormap from 0-1 to 0 -255 for Qt
-           lut = lut[:256,0:3]
-           nCols = np.shape(lut)[0]   # Seem to be 513 x 4
-               
-           self.colortable = []
-           for i in range(0, 256):
-               col = int(round(i * nCols / 256))
-               self.colortable.append(QtGui.qRgb(lut[col,0],lut[col,1],lut[col,2]))
-       self.update()
+           self.colortable = colormap_colortable(colormapName)
+       self.colormapVersion = self.colormapVersion + 1
+       
+       # The colormap is applied by the QImage, so the image does not need to
+       # be mapped again
+       self.update_view()
+       
+       
+   def set_gamma(self, gamma):
+       """ Sets the display gamma. After scaling to the display range, pixel 
+       values are normalised to between 0 and 1 and raised to the power 
+       `gamma`, so values less than 1 brighten dark regions. The default is 1.
+       """
+       self.displayGamma = float(gamma)
+       self.refresh()
+       
+       
+   def set_rgb_linked_scale(self, rgbLinkedScale):
+       """ Sets whether colour images are autoscaled using the same range for
+       all channels (True, default), preserving the colour balance, or with 
+       each channel scaled separately (False).
+       """
+       self.rgbLinkedScale = rgbLinkedScale
+       self.refresh()
        
        
    def set_display_range(self, lower, upper):
        """ Sets the intensity range used for display if set_auto_scale is False. Pixels
-       of 'lower' or below will be mapped to 0, 'upper' and above to 255.
+       of 'lower' or below will be mapped to 0, 'upper' and above to 255. For
+       colour images, 'lower' and 'upper' can also be tuples of one value per
+       channel. Monochrome images are then displayed using the lowest of the 
+       'lower' values and the highest of the 'upper' values.
        """
        self.displayMin = lower
        self.displayMax = upper
-       self.update()
+       self.refresh()
        
 
    def get_display_range(self):
@@ -856,6 +2571,24 @@ class ImageDisplay(QLabel):
        return self.displayMin, self.displayMax
    
        
+   def set_read_only_view_enabled(self, useReadOnlyView):
+       """ Sets whether the current image is kept as a read-only view of the 
+       array passed to set_image (True), so that it cannot be modified through 
+       the display (for example via get_image), or as the array itself (False, 
+       default). In both cases the image is not copied.
+       """
+       self.useReadOnlyView = useReadOnlyView
+       
+       
+   def set_viewport_first(self, viewportFirst):
+       """ Sets whether images are cropped to the zoomed region before being
+       mapped for display (True, default) or mapped in full and then cropped 
+       (False). Autoscaling gives the same result in both cases.
+       """
+       self.viewportFirst = viewportFirst
+       self.refresh()
+       
+       
    def set_zoom_step_divider(self, zoomDivider):
        """ Sets the zoom step divider. A bigger value makes the amount zoomed
        in by each mouse wheel step smaller.
@@ -864,6 +2597,31 @@ class ImageDisplay(QLabel):
            self.zoomStepDivider = zoomDivider
            
          
+class PerformanceStats():
+    """ Class to store measurements of display performance, as returned by
+    ImageDisplay.performance_stats. Frame rates are in frames per second and 
+    stage times are the mean time per call in ms, both measured over the last
+    update interval. 
+    """
+    
+    inputFps = 0
+    paintFps = 0
+    droppedFrames = 0
+    unpaintedFrames = 0
+    stageTimes = {}
+    
+    def __init__(self):
+        
+        self.stageTimes = {}
+        
+        
+    def __repr__(self):
+        
+        return ('PerformanceStats(inputFps=' + str(round(self.inputFps, 1)) + ', paintFps=' + str(round(self.paintFps, 1)) 
+                + ', droppedFrames=' + str(self.droppedFrames) + ', unpaintedFrames=' + str(self.unpaintedFrames) 
+                + ', stageTimes=' + str({stage: round(ms, 3) for stage, ms in self.stageTimes.items()}) + ')')
+    
+    
 class Overlay():
     """ Class to store details about an overlay.
     """
@@ -886,4 +2644,145 @@ class Overlay():
         self.y2 = y2
         self.pen = pen
         self.fill = fill
-        self.text = text
\ No newline at end of file
+        self.text = text
+
+        
+class OverlayCollection():
+    """ Class to store many overlays of the same type as arrays of positions
+    and sizes, created using ImageDisplay.add_overlay_collection.
+    """
+    
+    overlayType = None
+    x = None
+    y = None
+    w = None
+    h = None
+    pens = None
+    fills = None
+    styles = None
+    version = 0
+    index = None
+    indexVersion = None
+    
+    def __init__(self, overlayType, pen, fill):
+        
+        self.overlayType = overlayType
+        self.pens = list(pen) if isinstance(pen, (list, tuple)) else [pen]
+        self.fills = list(fill) if isinstance(fill, (list, tuple)) else [fill]
+        
+        
+    def set_data(self, x, y, w = None, h = None, styles = None):
+        """ Sets the positions, sizes and (optionally) style indices of the 
+        elements. w and h can be arrays or single values.
+        """
+        self.x = np.asarray(x, dtype = 'float64').ravel()
+        self.y = np.asarray(y, dtype = 'float64').ravel()
+        numElements = np.size(self.x)
+        self.w = np.broadcast_to(np.asarray(1 if w is None else w, dtype = 'float64'), numElements).ravel()
+        self.h = np.broadcast_to(np.asarray(1 if h is None else h, dtype = 'float64'), numElements).ravel()
+        if styles is None:
+            self.styles = None
+        else:
+            self.styles = np.asarray(styles, dtype = 'intp').ravel()
+        self.version = self.version + 1
+            
+            
+    def spatial_index(self):
+        """ Returns an OverlayIndex of the elements, which is rebuilt only
+        when the data has changed.
+        """
+        if self.indexVersion != self.version:
+            if self.overlayType == ImageDisplay.POINT:
+                self.index = OverlayIndex(self.x, self.y, self.x, self.y)
+            else:    
+                self.index = OverlayIndex(np.minimum(self.x, self.x + self.w), np.minimum(self.y, self.y + self.h),
+                                          np.maximum(self.x, self.x + self.w), np.maximum(self.y, self.y + self.h))
+            self.indexVersion = self.version
+        return self.index
+    
+    
+    def num_elements(self):
+        """ Returns the number of elements in the collection.
+        """
+        return 0 if self.x is None else np.size(self.x)
+    
+    
+    def pen(self, style):
+        """ Returns the pen for elements with the specified style index.
+        """
+        return self.pens[style % len(self.pens)]
+    
+    
+    def fill(self, style):
+        """ Returns the fill for elements with the specified style index, or None.
+        """
+        return self.fills[style % len(self.fills)]
+
+    
+class OverlayIndex():
+    """ Uniform grid spatial index of bounding boxes (x1, y1, x2, y2), used to
+    find the overlays within the current view and under the cursor without 
+    testing each one. Boxes are binned by their top left corner into square
+    cells sized so that there are a few boxes per cell. Boxes much larger than 
+    a cell are kept in a separate list and always tested.
+    """
+    
+    boxesPerCell = 4
+    
+    def __init__(self, x1, y1, x2, y2):
+        
+        self.x1, self.y1, self.x2, self.y2 = (np.asarray(v, dtype = 'float64') for v in (x1, y1, x2, y2))
+        numBoxes = np.size(self.x1)
+        if numBoxes == 0:
+            self.extent = (0, 0, 0, 0)
+            return
+        
+        self.extent = (self.x1.min(), self.y1.min(), self.x2.max(), self.y2.max())
+        area = (self.extent[2] - self.extent[0]) * (self.extent[3] - self.extent[1])
+        self.cellSize = max(math.sqrt(area * self.boxesPerCell / numBoxes), 1)
+        
+        sizes = np.maximum(self.x2 - self.x1, self.y2 - self.y1)
+        isLarge = sizes > 2 * self.cellSize
+        self.large = np.flatnonzero(isLarge)
+        small = np.flatnonzero(~isLarge)
+        
+        cellX = ((self.x1[small] - self.extent[0]) // self.cellSize).astype(np.int64)
+        cellY = ((self.y1[small] - self.extent[1]) // self.cellSize).astype(np.int64)
+        self.numCellsX = int((self.extent[2] - self.extent[0]) // self.cellSize) + 1
+        self.numCellsY = int((self.extent[3] - self.extent[1]) // self.cellSize) + 1
+        cells = cellY * self.numCellsX + cellX
+        order = np.argsort(cells, kind = 'stable')
+        self.cells = cells[order]
+        self.boxes = small[order]
+        
+        
+    def query(self, x1, y1, x2, y2):
+        """ Returns a sorted array of the indices of the boxes which intersect
+        the rectangle (x1, y1, x2, y2), or None if the rectangle contains all 
+        the boxes.
+        """
+        if x1 <= self.extent[0] and y1 <= self.extent[1] and x2 >= self.extent[2] and y2 >= self.extent[3]:
+            return None
+        if np.size(self.x1) == 0:
+            return np.zeros(0, dtype = int)
+        
+        # Small boxes may start up to 2 cells before the rectangle
+        firstX = max(int((x1 - self.extent[0]) // self.cellSize) - 2, 0)
+        firstY = max(int((y1 - self.extent[1]) // self.cellSize) - 2, 0)
+        lastX = min(int((x2 - self.extent[0]) // self.cellSize), self.numCellsX - 1)
+        lastY = min(int((y2 - self.extent[1]) // self.cellSize), self.numCellsY - 1)
+        
+        if firstX <= lastX and firstY <= lastY:
+            # Each row of cells is a contiguous range of the sorted boxes
+            rows = np.arange(firstY, lastY + 1, dtype = np.int64) * self.numCellsX
+            starts = np.searchsorted(self.cells, rows + firstX, side = 'left')
+            ends = np.searchsorted(self.cells, rows + lastX, side = 'right')
+            lengths = ends - starts
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            candidates = np.concatenate((self.boxes[np.arange(lengths.sum()) + offsets], self.large))
+        else:
+            candidates = self.large
+        
+        inside = ((self.x1[candidates] <= x2) & (self.x2[candidates] >= x1) 
+                  & (self.y1[candidates] <= y2) & (self.y2[candidates] >= y1))
+        return np.sort(candidates[inside])
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Colormaps for ImageDisplay.
+
+Precomputed 256 entry lookup tables for commonly used colormaps, so that 
+matplotlib does not need to be imported to use them. Other matplotlib 
+colormaps can still be used if matplotlib is installed, in which case it is
+imported the first time one is requested. Tables and Qt colour tables are 
+cached for the whole process, so setting the same colormap on many displays
+only builds it once.
+
+The tables were generated from matplotlib 3.11.2 using 
+cmap.resampled(256)(range(256), bytes = True), as in matplotlib_table, and 
+are stored as hex strings of r, g, b bytes. For colormaps with more than 256 
+entries, such as twilight, this samples the whole colormap.
+Reversed versions are available by adding '_r' to the name.
+
+@author: Mike Hughes
+Applied Optics Group
+School of Physics & Astronomoy
+University of Kent
+"""
+
+import numpy as np
+
+
+tableCache = {}
+colortableCache = {}
+
+COLORMAPS = {
+   'gray': (
+       '0000000101010202020303030404040505050606060707070808080909090a0a0a0b0b0b0c0c0c0d0d0d0e0e0e0f0f0f'
+       '1010101111111212121313131414141515151616161717171818181919191a1a1a1b1b1b1c1c1c1d1d1d1e1e1e1f1f1f'
+       '2020202020202222222323232424242424242626262727272828282828282a2a2a2b2b2b2c2c2c2c2c2c2e2e2e2f2f2f'
+       '3030303030303232323333333434343434343636363737373838383838383a3a3a3b3b3b3c3c3c3c3c3c3e3e3e3f3f3f'
+       '4040404141414141414343434444444545454646464747474848484949494949494b4b4b4c4c4c4d4d4d4e4e4e4f4f4f'
+       '5050505151515151515353535454545555555656565757575858585959595959595b5b5b5c5c5c5d5d5d5e5e5e5f5f5f'
+       '6060606161616161616363636464646565656666666767676868686969696969696b6b6b6c6c6c6d6d6d6e6e6e6f6f6f'
+       '7070707171717171717373737474747575757676767777777878787979797979797b7b7b7c7c7c7d7d7d7e7e7e7f7f7f'
+       '8080808181818282828383838383838585858686868787878888888989898a8a8a8b8b8b8c8c8c8d8d8d8e8e8e8f8f8f'
+       '9090909191919292929393939393939595959696969797979898989999999a9a9a9b9b9b9c9c9c9d9d9d9e9e9e9f9f9f'
+       'a0a0a0a1a1a1a2a2a2a3a3a3a3a3a3a5a5a5a6a6a6a7a7a7a8a8a8a9a9a9aaaaaaabababacacacadadadaeaeaeafafaf'
+       'b0b0b0b1b1b1b2b2b2b3b3b3b3b3b3b5b5b5b6b6b6b7b7b7b8b8b8b9b9b9babababbbbbbbcbcbcbdbdbdbebebebfbfbf'
+       'c0c0c0c1c1c1c2c2c2c3c3c3c3c3c3c5c5c5c6c6c6c7c7c7c8c8c8c9c9c9cacacacbcbcbcccccccdcdcdcecececfcfcf'
+       'd0d0d0d1d1d1d2d2d2d3d3d3d3d3d3d5d5d5d6d6d6d7d7d7d8d8d8d9d9d9dadadadbdbdbdcdcdcdddddddedededfdfdf'
+       'e0e0e0e1e1e1e2e2e2e3e3e3e3e3e3e5e5e5e6e6e6e7e7e7e8e8e8e9e9e9eaeaeaebebebecececedededeeeeeeefefef'
+       'f0f0f0f1f1f1f2f2f2f3f3f3f3f3f3f5f5f5f6f6f6f7f7f7f8f8f8f9f9f9fafafafbfbfbfcfcfcfdfdfdfefefeffffff'),
+   'viridis': (
+       '44015444025544035745055845065a45085b46095c460b5e460c5f460e61470f62471163471265471466471567471669'
+       '47186a48196b481a6c481c6e481d6f481e70482071482172482273482374472575472676472777472878472a79472b7a'
+       '472c7b462d7c462f7c46307d46317e45327f45347f453580453681443781443982433a83433b83433c84423d84423e85'
+       '4240854141864142864043874044873f45873f47883e48883e49893d4a893d4b893d4c893c4d8a3c4e8a3b508a3b518a'
+       '3a528b3a538b39548b39558b38568b38578c37588c37598c365a8c365b8c355c8c355d8c345e8d345f8d33608d33618d'
+       '32628d32638d31648d31658d31668d30678d30688d2f698d2f6a8d2e6b8e2e6c8e2e6d8e2d6e8e2d6f8e2c708e2c718e'
+       '2c728e2b738e2b748e2a758e2a768e2a778e29788e29798e287a8e287a8e287b8e277c8e277d8e277e8e267f8e26808e'
+       '26818e25828e25838d24848d24858d24868d23878d23888d23898d22898d228a8d228b8d218c8d218d8c218e8c208f8c'
+       '20908c20918c1f928c1f938b1f948b1f958b1f968b1e978a1e988a1e998a1e998a1e9a891e9b891e9c891e9d881e9e88'
+       '1e9f881ea0871fa1871fa2861fa38620a48520a58521a68521a78422a78423a88323a98224aa8225ab8126ac8127ad80'
+       '28ae7f29af7f2ab07e2bb17d2cb17d2eb27c2fb37b30b47a32b57a33b67935b77836b87738b97639b9763bba753dbb74'
+       '3ebc7340bd7242be7144be7045bf6f47c06e49c16d4bc26c4dc26b4fc36951c46853c56755c66657c66559c7645bc862'
+       '5ec96160c96062ca5f64cb5d67cc5c69cc5b6bcd596dce5870ce5672cf5574d05477d05279d1517cd24f7ed24e81d34c'
+       '83d34b86d44988d5478bd5468dd64490d64392d74195d73f97d83e9ad83c9dd93a9fd938a2da37a5da35a7db33aadb32'
+       'addc30afdc2eb2dd2cb5dd2bb7dd29bade27bdde26bfdf24c2df22c5df21c7e01fcae01ecde01dcfe11cd2e11bd4e11a'
+       'd7e219dae218dce218dfe318e1e318e4e318e7e419e9e419ece41aeee51bf1e51cf3e51ef6e61ff8e621fae622fde724'),
+   'plasma': (
+       '0c078610078713068915068a18068b1b068c1d068d1f058e21058f2305902505912705922905932b05942d04942f0495'
+       '3104963304973404983604983804993a049a3b039a3d039b3f039c40039c42039d44039e45039e47029f49029f4a02a0'
+       '4c02a14e02a14f02a25101a25201a35401a35601a35701a45901a45a00a55c00a55e00a55f00a66100a66200a66400a7'
+       '6500a76700a76800a76a00a76c00a86d00a86f00a87000a87200a87300a87500a87601a87801a87901a87b02a87c02a7'
+       '7e03a77f03a78104a78204a78405a68506a68607a68807a58908a58b09a48c0aa48e0ca48f0da3900ea3920fa29310a1'
+       '9511a19612a09713a099149f9a159e9b179e9d189d9e199c9f1a9ba01b9ba21c9aa31d99a41e98a51f97a72197a82296'
+       'a92395aa2494ac2593ad2692ae2791af2890b02a8fb12b8fb22c8eb42d8db52e8cb62f8bb7308ab83289b93388ba3487'
+       'bb3586bc3685bd3784be3883bf3982c03b81c13c80c23d80c33e7fc43f7ec5407dc6417cc7427bc8447ac94579ca4678'
+       'cb4777cc4876cd4975ce4a75cf4b74d04d73d14e72d14f71d25070d3516fd4526ed5536dd6556dd7566cd7576bd8586a'
+       'd95969da5a68db5b67dc5d66dc5e66dd5f65de6064df6163df6262e06461e16560e26660e3675fe3685ee46a5de56b5c'
+       'e56c5be66d5ae76e5ae87059e87158e97257ea7356ea7455eb7654ec7754ec7853ed7952ed7b51ee7c50ef7d4fef7e4e'
+       'f0804df0814df1824cf2844bf2854af38649f38748f48947f48a47f58b46f58d45f68e44f68f43f69142f79241f79341'
+       'f89540f8963ff8983ef9993df99a3cfa9c3bfa9d3afa9f3afaa039fba238fba337fba436fca635fca735fca934fcaa33'
+       'fcac32fcad31fdaf31fdb030fdb22ffdb32efdb52dfdb62dfdb82cfdb92bfdbb2bfdbc2afdbe29fdc029fdc128fdc328'
+       'fdc427fdc626fcc726fcc926fccb25fccc25fcce25fbd024fbd124fbd324fad524fad624fad824f9d924f9db24f8dd24'
+       'f8df24f7e024f7e225f6e425f6e525f5e726f5e926f4ea26f3ec26f3ee26f2f026f2f126f1f326f0f525f0f623eff821'),
+   'inferno': (
+       '00000300000400000601000701010901010b02010e02021003021204031404031605041806041b07051d08061f090621'
+       '0a07230b07260d08280e082a0f092d10092f120a32130a34140b36160b39170b3b190b3e1a0b401c0c431d0c451f0c47'
+       '200c4a220b4c240b4e260b50270b52290b542b0a562d0a582e0a5a300a5c32095d34095f3509603709613909623b0964'
+       '3c09653e0966400966410967430a68450a69460a69480b6a4a0b6a4b0c6b4d0c6b4f0d6c500d6c520e6c530e6d550f6d'
+       '570f6d58106d5a116d5b116e5d126e5f126e60136e62146e63146e65156e66156e68166e6a176e6b176e6d186e6e186e'
+       '70196e72196d731a6d751b6d761b6d781c6d7a1c6d7b1d6c7d1d6c7e1e6c801f6b811f6b83206b85206a86216a88216a'
+       '8922698b22698d23698e24689024689125679325679526669626669827659928649b28649c29639e2963a02a62a12b61'
+       'a32b61a42c60a62c5fa72d5fa92e5eab2e5dac2f5cae305baf315bb1315ab23259b43358b53357b73456b83556ba3655'
+       'bb3754bd3753be3852bf3951c13a50c23b4fc43c4ec53d4dc73e4cc83e4bc93f4acb4049cc4148cd4247cf4446d04544'
+       'd14643d24742d44841d54940d64a3fd74b3ed94d3dda4e3bdb4f3adc5039dd5238de5337df5436e05634e25733e35832'
+       'e45a31e55b30e65c2ee65e2de75f2ce8612be9622aea6428eb6527ec6726ed6825ed6a23ee6c22ef6d21f06f1ff0701e'
+       'f1721df2741cf2751af37719f37918f47a16f57c15f57e14f68012f68111f78310f7850ef8870df8880cf88a0bf98c09'
+       'f98e08f99008fa9107fa9306fa9506fa9706fb9906fb9b06fb9d06fb9e07fba007fba208fba40afba60bfba80dfbaa0e'
+       'fbac10fbae12fbb014fbb116fbb318fbb51afbb71cfbb91efabb21fabd23fabf25fac128f9c32af9c52cf9c72ff8c931'
+       'f8cb34f8cd37f7cf3af7d13cf6d33ff6d542f5d745f5d948f4db4bf4dc4ff3de52f3e056f3e259f2e45df2e660f1e864'
+       'f1e968f1eb6cf1ed70f1ee74f1f079f1f27df2f381f2f485f3f689f4f78df5f891f6fa95f7fb99f9fc9dfafda0fcfea4'),
+   'magma': (
+       '00000300000400000601000701010901010b02020d02020f03031104031304041505041706051907051b08061d09071f'
+       '0a07220b08240c09260d0a280e0a2a0f0b2c100c2f110c31120d33140d35150e38160e3a170f3c180f3f1a10411b1044'
+       '1c10461e10491f114b20114d2211502311522511552611572811592a115c2b115e2d10602f1062301065321067341068'
+       '350f6a370f6c390f6e3b0f6f3c0f713e0f72400f73420f74430f75450f76470f774810784a10794b10794d117a4f117b'
+       '50127b52127c53137c55137d57147d58157e5a157e5b167e5d177e5e177f60187f61187f63197f651a80661a80681b80'
+       '691c806b1c806c1d806e1e816f1e81711f81731f817420817621817721817922817a22817c23817e24817f2481812581'
+       '8225818426818526818727818928818a28818c29808d29808f2a80912a80922b80942b80952c80972c7f992d7f9a2d7f'
+       '9c2e7f9e2e7e9f2f7ea12f7ea3307ea4307da6317da7317da9327cab337cac337bae347bb0347bb1357ab3357ab53679'
+       'b63679b83778b93778bb3877bd3977be3976c03a75c23a75c33b74c53c74c63c73c83d72ca3e72cb3e71cd3f70ce4070'
+       'd0416fd1426ed3426dd4436dd6446cd7456bd9466ada4769dc4869dd4968de4a67e04b66e14c66e24d65e44e64e55063'
+       'e65162e75262e85461ea5560eb5660ec585fed595fee5b5eee5d5def5e5df0605df1615cf2635cf3655cf3675bf4685b'
+       'f56a5bf56c5bf66e5bf6705bf7715bf7735cf8755cf8775cf9795cf97b5df97d5dfa7f5efa805efa825ffb8460fb8660'
+       'fb8861fb8a62fc8c63fc8e63fc9064fc9265fc9366fd9567fd9768fd9969fd9b6afd9d6bfd9f6cfda16efda26ffda470'
+       'fea671fea873feaa74feac75feae76feaf78feb179feb37bfeb57cfeb77dfeb97ffebb80febc82febe83fec085fec286'
+       'fec488fec689fec78bfec98dfecb8efdcd90fdcf92fdd193fdd295fdd497fdd698fdd89afdda9cfddc9dfddd9ffddfa1'
+       'fde1a3fce3a5fce5a6fce6a8fce8aafceaacfcecaefceeb0fcf0b1fcf1b3fcf3b5fcf5b7fbf7b9fbf9bbfbfabdfbfcbf'),
+   'cividis': (
+       '00224d00234f00235000245200255400265500265700275900285b00285c00295e002a60002a62002b64002c66002c67'
+       '002d69002e6b002f6d002f6f0030700030700031700031700432700833700b33700e347011356f14366f16366f18376f'
+       '1a386f1c386e1d396e1f3a6e213b6e223b6e243c6e253d6d273d6d283e6d2a3f6d2b3f6d2c406d2e416c2f426c30426c'
+       '31436c32446c34446c35456c36466c37466c38476c39486c3a486b3b496b3d4a6b3e4b6b3f4b6b404c6b414d6b424d6b'
+       '434e6b444f6b454f6b46506b47516b48516b49526b4a536b4b546c4c546c4d556c4e566c4e566c4f576c50586c51586c'
+       '52596c535a6c545a6c555b6d565c6d575d6d585d6d595e6d595f6d5a5f6d5b606e5c616e5d616e5e626e5f636e60646e'
+       '61646f61656f62666f63666f64676f656870666970676970686a70686b71696b716a6c716b6d716c6d726d6e726e6f72'
+       '6e70736f70737071737172737273747373747474757475757575757676767777767878767978777979777a7a777b7b77'
+       '7c7b787d7c787e7d787f7d78807e78817f788280788380788481788582788583788683788784788885788986788a8678'
+       '8b87788c88788d89788e89788f8a77908b77918c77928c77938d77948e77958f77968f779790769891769992769a9376'
+       '9b93769c94769d95759e96759f9675a09775a19874a29974a39a74a49a74a59b73a69c73a79d73a89e73a99e72aa9f72'
+       'aba072aca171ada271aea271afa370b0a470b1a570b2a66fb3a66fb4a76fb5a86eb6a96eb7aa6db8ab6db9ab6dbaac6c'
+       'bbad6cbcae6bbdaf6bbeb06abfb06ac1b169c2b269c3b368c4b468c5b567c6b567c7b666c8b765c9b865cab964cbba64'
+       'ccbb63cdbc62cebc62cfbd61d0be60d2bf60d3c05fd4c15ed5c25ed6c35dd7c35cd8c45bd9c55adac65adbc759dcc858'
+       'dec957dfca56e0cb55e1cc54e2cc53e3cd52e4ce51e5cf50e6d04fe8d14ee9d24dead34cebd44becd54aedd648eed747'
+       'efd846f1d944f2da43f3da42f4db40f5dc3ff6dd3df8de3bf9df3afae038fbe136fde234fde333fde534fde636fde737'),
+   'hot': (
+       '0a00000d00000f00001200001500001700001a00001c00001f00002200002400002700002a00002c00002f0000310000'
+       '3400003700003900003c00003f00004100004400004600004900004c00004e00005100005400005600005900005b0000'
+       '5e00006100006300006600006900006b00006e00007000007300007600007800007b00007e0000800000830000850000'
+       '8800008b00008d00009000009300009500009800009a00009d0000a00000a20000a50000a80000aa0000ad0000af0000'
+       'b20000b50000b70000ba0000bd0000bf0000c20000c40000c70000ca0000cc0000cf0000d20000d40000d70000d90000'
+       'dc0000df0000e10000e40000e70000e90000ec0000ee0000f10000f40000f60000f90000fc0000fe0000ff0200ff0500'
+       'ff0700ff0a00ff0c00ff0f00ff1200ff1400ff1700ff1a00ff1c00ff1f00ff2100ff2400ff2700ff2900ff2c00ff2f00'
+       'ff3100ff3400ff3600ff3900ff3c00ff3e00ff4100ff4400ff4600ff4900ff4b00ff4e00ff5100ff5300ff5600ff5900'
+       'ff5b00ff5e00ff6000ff6300ff6600ff6800ff6b00ff6e00ff7000ff7300ff7500ff7800ff7b00ff7d00ff8000ff8300'
+       'ff8500ff8800ff8a00ff8d00ff9000ff9200ff9500ff9700ff9a00ff9d00ff9f00ffa200ffa500ffa700ffaa00ffac00'
+       'ffaf00ffb200ffb400ffb700ffba00ffbc00ffbf00ffc100ffc400ffc700ffc900ffcc00ffcf00ffd100ffd400ffd600'
+       'ffd900ffdc00ffde00ffe100ffe400ffe600ffe900ffeb00ffee00fff100fff300fff600fff900fffb00fffe00ffff02'
+       'ffff06ffff0affff0effff12ffff16ffff1affff1effff22ffff26ffff2affff2effff32ffff36ffff3affff3effff41'
+       'ffff45ffff49ffff4dffff51ffff55ffff59ffff5dffff61ffff65ffff69ffff6dffff71ffff75ffff79ffff7dffff80'
+       'ffff84ffff88ffff8cffff90ffff94ffff98ffff9cffffa0ffffa4ffffa8ffffacffffb0ffffb4ffffb8ffffbcffffbf'
+       'ffffc3ffffc7ffffcbffffcfffffd3ffffd7ffffdbffffdfffffe3ffffe7ffffebffffeffffff3fffff7fffffbffffff'),
+   'bone': (
+       '00000000000101010202020303030404040605050706060807060907070a08080c09090d0a0a0e0b0b0f0c0c110d0d12'
+       '0e0d130e0e140f0f1510101711111812121913131a14141c15141d15151e16161f1717201818221919231a1a241b1b25'
+       '1c1b261c1c281d1d291e1e2a1f1f2b20202d21212e22222f232230232331242433252534262635272736282838292939'
+       '2a293a2a2a3b2b2b3c2c2c3e2d2d3f2e2e402f2f4130304231304431314532324633334734344935354a36364b37374c'
+       '38374d38384f3939503a3a513b3b523c3c543d3d553e3e563f3e573f3f5840405a41415b42425c43435d44445e454560'
+       '4645614646624747634848654949664a4a674b4b684c4c694d4c6b4d4d6c4e4e6d4f4f6e505070515171525272535372'
+       '545473545674555775565876575977585a78595c795a5d795b5e7a5b5f7b5c607c5d627d5e637e5f647f606580616680'
+       '626881626982636a83646b84656d85666e86676f876870876971886973896a748a6b758b6c768c6d778d6e798e6f7a8e'
+       '707b8f707c90717d91727f927380937481947582957683957785967786977887987988997a899a7b8b9b7c8c9c7d8d9c'
+       '7e8e9d7e8f9e7f919f8092a08193a18294a28395a38497a38598a48599a5869aa6879ba7889da8899ea98a9faa8ba0aa'
+       '8ca1ab8ca3ac8da4ad8ea5ae8fa6af90a7b091a9b192aab193abb293acb394adb495afb596b0b697b1b798b2b899b3b8'
+       '9ab5b99ab6ba9bb7bb9cb8bc9dbabd9ebbbe9fbcbfa0bdbfa1bec0a1c0c1a2c1c2a3c2c3a4c3c4a5c4c5a6c6c6a7c7c6'
+       'a8c7c7aac8c8abc9c9accacaaecbcbafccccb1cdcdb2cecdb3ceceb5cfcfb6d0d0b7d1d1b9d2d2bad3d3bcd4d4bdd5d4'
+       'bed5d5c0d6d6c1d7d7c2d8d8c4d9d9c5dadac6dbdbc8dcdbc9dcdccbddddccdedecddfdfcfe0e0d0e1e1d1e2e2d3e3e2'
+       'd4e3e3d5e4e4d7e5e5d8e6e6dae7e7dbe8e8dce9e9deeae9dfeaeae0ebebe2ecece3edede5eeeee6efefe7f0f0e9f1f0'
+       'eaf1f1ebf2f2edf3f3eef4f4eff5f5f1f6f6f2f7f7f4f8f7f5f8f8f6f9f9f8fafaf9fbfbfafcfcfcfdfdfdfefeffffff'),
+   'jet': (
+       '00007f00008400008800008d00009100009600009a00009f0000a30000a80000ac0000b10000b60000ba0000bf0000c3'
+       '0000c80000cc0000d10000d50000da0000de0000e30000e80000ec0000f10000f50000fa0000fe0000ff0000ff0000ff'
+       '0000ff0004ff0008ff000cff0010ff0014ff0018ff001cff0020ff0024ff0028ff002cff0030ff0034ff0038ff003cff'
+       '0040ff0044ff0048ff004cff0050ff0054ff0058ff005cff0060ff0064ff0068ff006cff0070ff0074ff0078ff007cff'
+       '0080ff0084ff0088ff008cff0090ff0094ff0098ff009cff00a0ff00a4ff00a8ff00acff00b0ff00b4ff00b8ff00bcff'
+       '00c0ff00c4ff00c8ff00ccff00d0ff00d4ff00d8ff00dcfe00e0fa00e4f702e8f405ecf108f0ed0cf4ea0ff8e712fce4'
+       '15ffe118ffdd1cffda1fffd722ffd425ffd029ffcd2cffca2fffc732ffc336ffc039ffbd3cffba3fffb742ffb346ffb0'
+       '49ffad4cffaa4fffa653ffa356ffa059ff9d5cff9a5fff9663ff9366ff9069ff8d6cff8970ff8673ff8376ff8079ff7d'
+       '7cff7980ff7683ff7386ff7089ff6c8dff6990ff6693ff6396ff5f9aff5c9dff59a0ff56a3ff53a6ff4faaff4cadff49'
+       'b0ff46b3ff42b7ff3fbaff3cbdff39c0ff36c3ff32c7ff2fcaff2ccdff29d0ff25d4ff22d7ff1fdaff1cddff18e0ff15'
+       'e4ff12e7ff0feaff0cedff08f1fc05f4f802f7f400faf000feed00ffe900ffe500ffe200ffde00ffda00ffd700ffd300'
+       'ffcf00ffcb00ffc800ffc400ffc000ffbd00ffb900ffb500ffb100ffae00ffaa00ffa600ffa300ff9f00ff9b00ff9800'
+       'ff9400ff9000ff8c00ff8900ff8500ff8100ff7e00ff7a00ff7600ff7300ff6f00ff6b00ff6700ff6400ff6000ff5c00'
+       'ff5900ff5500ff5100ff4d00ff4a00ff4600ff4200ff3f00ff3b00ff3700ff3400ff3000ff2c00ff2800ff2500ff2100'
+       'ff1d00ff1a00ff1600fe1200fa0f00f50b00f10700ec0300e80000e30000de0000da0000d50000d10000cc0000c80000'
+       'c30000bf0000ba0000b60000b10000ac0000a80000a300009f00009a00009600009100008d00008800008400007f0000'),
+   'turbo': (
+       '30123b31154232184a341b51351e5836215f37236538266c3929723a2c793b2f7f3c32853c358b3d37913e3a963f3d9c'
+       '4040a14043a64145ab4148b0424bb5434eba4350be4353c24456c74458cb455bce455ed24560d64563d94666dd4668e0'
+       '466be3466de64670e84673eb4675ed4678f0467af2467df4467ff64682f84584f94587fb4589fc448cfd438efd4291fe'
+       '4193fe4096fe3f98fe3e9bfe3c9dfd3ba0fc39a2fc38a5fb36a8f934aaf833acf631aff52fb1f32db4f12bb6ef2ab9ed'
+       '28bbeb26bde925c0e623c2e421c4e120c6df1ec9dc1dcbda1ccdd71bcfd41ad1d219d3cf18d5cc18d7ca17d9c717dac4'
+       '17dcc217debf18e0bd18e1ba19e3b81ae4b61be5b41de7b11ee8af20e9ac22eba924eca627eda329eea02cef9d2ff09a'
+       '32f19735f39438f4913bf48d3ff58a42f68746f7834af8804df97c51f97955fa7659fb725dfb6f61fc6c65fc6869fd65'
+       '6dfd6271fd5f74fe5c78fe597cfe5680fe5384fe5087fe4d8bfe4b8efe4892fe4695fe4498fe429bfd409efd3ea1fc3d'
+       'a4fc3ba6fb3aa9fb39acfa37aef937b1f836b3f835b6f735b9f534bbf434bef334c0f233c3f133c5ef33c8ee33caed33'
+       'cdeb34cfea34d1e834d4e735d6e535d8e335dae236dde036dfde36e1dc37e3da37e5d838e7d738e8d538ead339ecd139'
+       'edcf39efcd39f0cb3af2c83af3c63af4c43af6c23af7c039f8be39f9bc39f9ba38fab737fbb537fbb336fcb035fcae34'
+       'fdab33fda932fda631fda330fea12ffe9e2efe9b2dfe982cfd952bfd9229fd8f28fd8c27fc8926fc8624fb8323fb8022'
+       'fa7d20fa7a1ff9771ef8741cf7711bf76e1af66b18f56817f46516f36315f26014f15d13ef5a11ee5810ed550fec520e'
+       'ea500de94d0de84b0ce6490be5460ae3440ae24209e04008de3e08dd3c07db3a07d93806d73606d63405d43205d23005'
+       'd02f04ce2d04cb2b03c92903c72803c52602c32402c02302be2102bb1f01b91e01b61c01b41b01b11901ae1801ac1601'
+       'a91501a61401a31201a011019d10019a0e01970d01940c01910b018e0a018b09018708018407018106027d05027a0402'),
+   'hsv': (
+       'ff0000ff0500ff0b00ff1100ff1700ff1d00ff2300ff2900ff2f00ff3500ff3b00ff4000ff4600ff4c00ff5200ff5800'
+       'ff5e00ff6400ff6a00ff7000ff7600ff7c00ff8100ff8700ff8d00ff9300ff9900ff9f00ffa500ffab00ffb100ffb700'
+       'ffbd00ffc200ffc800ffce00ffd400ffda00ffe000ffe600ffec00fdf100fbf500faf900f8fc00f4ff00eeff00e8ff00'
+       'e2ff00dcff00d6ff00d0ff00caff00c4ff00bfff00b9ff00b3ff00adff00a7ff00a1ff009bff0095ff008fff0089ff00'
+       '83ff007eff0078ff0072ff006cff0066ff0060ff005aff0054ff004eff0048ff0043ff003dff0037ff0031ff002bff00'
+       '25ff001fff0019ff0013ff000dff0007ff0005ff0304ff0702ff0b00ff0f00ff1500ff1b00ff2100ff2700ff2d00ff33'
+       '00ff3900ff3e00ff4400ff4a00ff5000ff5600ff5c00ff6200ff6800ff6e00ff7400ff7900ff7f00ff8500ff8b00ff91'
+       '00ff9700ff9d00ffa300ffa900ffaf00ffb500ffba00ffc000ffc600ffcc00ffd200ffd800ffde00ffe400ffea00fff0'
+       '00fff500fffb00fcff00f6ff00f0ff00eaff00e4ff00deff00d8ff00d2ff00ccff00c7ff00c1ff00bbff00b5ff00afff'
+       '00a9ff00a3ff009dff0097ff0091ff008bff0086ff0080ff007aff0074ff006eff0068ff0062ff005cff0056ff0050ff'
+       '004bff0045ff003fff0039ff0033ff002dff0027ff0021ff001bff0015ff000fff010cff0308ff0504ff0700ff0d00ff'
+       '1300ff1900ff1f00ff2500ff2b00ff3100ff3600ff3c00ff4200ff4800ff4e00ff5400ff5a00ff6000ff6600ff6c00ff'
+       '7100ff7700ff7d00ff8300ff8900ff8f00ff9500ff9b00ffa100ffa700ffad00ffb200ffb800ffbe00ffc400ffca00ff'
+       'd000ffd600ffdc00ffe200ffe800ffee00fff300fff700fdf900f9fb00f5fd00f1ff00ecff00e6ff00e0ff00daff00d4'
+       'ff00cfff00c9ff00c3ff00bdff00b7ff00b1ff00abff00a5ff009fff0099ff0093ff008eff0088ff0082ff007cff0076'
+       'ff0070ff006aff0064ff005eff0058ff0052ff004dff0047ff0041ff003bff0035ff002fff0029ff0023ff001dff0017'),
+   'twilight': (
+       'e1d8e2e0d9e2dfd9e1ded9e0ddd9e0dbd8dfd9d8ded8d7ddd6d6dcd4d6dbd2d5dacfd4d9cdd2d8cad1d7c7d0d6c5cfd4'
+       'c2cdd3bfccd2bccad1b9c9d0b6c7cfb3c6ceb0c4cdadc3ccaac1cba7c0caa4becaa1bcc99ebbc89bb9c898b7c796b5c6'
+       '93b4c692b3c68eb0c58baec589acc488abc484a9c382a7c380a5c37fa4c27ca1c27a9fc2789dc1779cc1749ac17398c0'
+       '7196c07095c06e92bf6d90bf6b8ebf6b8dbf6989be6887be6785bd6684bd6581bd647fbc647dbc637cbb6278bb6276ba'
+       '6174ba6172b96171b9606db8606bb75f69b65f67b65f64b55f62b45f60b35f5eb35e5bb15e59b05e56af5e54ae5e51ad'
+       '5e4fac5e4daa5e4baa5d48a75d45a65d43a45d40a35d3ea15c3c9f5c399d5c389c5b34995b32975a30955a2d92592b90'
+       '59298d58278b572589562285552182541f7f531d7c521b78501a754f19724e18704c166b4a156749156447146045135d'
+       '44125a4212574112553e11513d114e3b114b3a104838104637104336104135104033113d32113b32113a3012382f1337'
+       '2f13363112363212373311373411373611383711393911393b113a3d113b3f113c41113d43123e45123f4712404a1341'
+       '4c13424f14435114445415455515465916475c16485e174961184a63184b66194c691a4c6b1a4d6e1b4e711c4e731d4e'
+       '761e4f781f4f7b204f7d21507f22508224508425508727508928508b2a508d2c50902d50922f4f94314f96324f98344f'
+       '9a364f9b384f9d3a4f9f3c4fa03d4fa2404fa4424fa6444fa7464fa94950aa4b50ac4d50ad4f50af5151b05451b25652'
+       'b35852b45a53b55d53b65f54b76054b96456ba6657bb6857bc6b59bd6d5abe705bbf725cc0745dc0775fc17960c27c62'
+       'c37e64c38166c48368c5866ac5876bc68b6ec78d70c78f72c89275c89478c9977ac9997dca9c80ca9e83cba185cca389'
+       'cca58ccda88fcdaa92ceac95ceae97cfb19cd0b39fd1b6a3d2b8a6d3baa9d3bcadd4beb0d5c0b4d6c2b7d7c4bbd8c6be'
+       'd9c8c1dacac4dbccc8dbcecbdcceccddd1d0ded2d3ded3d5dfd5d7dfd6d9e0d6dbe0d7dde1d8dee1d8dfe1d8e1e1d8e1'),
+   }
+
+# Names which refer to the same colormap
+ALIASES = {'grey': 'gray'}
+
+
+def colormap_names():
+    """ Returns a list of the names of the built-in colormaps.
+    """
+    return list(COLORMAPS.keys())
+
+
+def colormap_table(name):
+    """ Returns the colormap `name` as a read-only numpy array of shape 
+    (256, 3) of uint8 r, g, b values. Built-in colormaps (and their reversed
+    '_r' versions) do not need matplotlib, other names are looked up in 
+    matplotlib if it is installed. Raises ValueError if the colormap is not
+    found.
+    """
+    if name in tableCache:
+        return tableCache[name]
+    
+    baseName = name[:-2] if name.endswith('_r') else name
+    baseName = ALIASES.get(baseName, baseName)
+    if baseName in COLORMAPS:
+        table = np.frombuffer(bytes.fromhex(COLORMAPS[baseName]), dtype = np.uint8).reshape(256, 3)
+        if name.endswith('_r'):
+            table = table[::-1]
+    else:
+        table = matplotlib_table(name)
+        
+    table = np.ascontiguousarray(table)
+    table.setflags(write = False)
+    tableCache[name] = table
+    return table
+    
+    
+def matplotlib_table(name):
+    """ Returns the matplotlib colormap `name` as an array of shape (256, 3)
+    of uint8 r, g, b values. matplotlib is only imported when this is called.
+    """
+    try:
+        import matplotlib
+    except ImportError:
+        raise ValueError("Colormap '" + str(name) + "' is not built in and matplotlib is not installed.")
+    
+    try:
+        if hasattr(matplotlib, 'colormaps'):
+            colormap = matplotlib.colormaps[name].resampled(256)
+        else:
+            from matplotlib import cm
+            colormap = cm.get_cmap(name, 256)
+    except (KeyError, ValueError):
+        raise ValueError("Colormap '" + str(name) + "' not found.")
+        
+    return colormap(np.arange(256), bytes = True)[:, 0:3]
+    
+    
+def colormap_colortable(name):
+    """ Returns the colormap `name` as a list of 256 colours in the 
+    0xffrrggbb format used by QImage.setColorTable.
+    """
+    if name not in colortableCache:
+        table = colormap_table(name).astype(np.uint32)
+        colortable = 0xff000000 | (table[:,0] << 16) | (table[:,1] << 8) | table[:,2]
+        colortableCache[name] = colortable.tolist()
+    return colortableCache[name]
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Frame sources for ImageDisplay.
+
+A frame source provides the frames of an image stack, such as a time-lapse
+recording, which are read from file only when they are needed rather than
+loading the whole stack into memory. Memory-mapped .npy and raw files and
+multi-page TIFF files are supported. Recently used frames are kept in a
+cache, and a background thread reads ahead the frames which will be needed
+next. A frame source can be played using ImageDisplay.set_frame_source.
+
+@author: Mike Hughes
+Applied Optics Group
+School of Physics & Astronomoy
+University of Kent
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def open_frame_source(filename, **kwargs):
+    """ Returns a frame source for the file `filename`, chosen by the file
+    extension. .npy files are memory-mapped, .tif/.tiff files are read using
+    Pillow, any other files are treated as raw data and require the keyword
+    arguments of RawFrameSource.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy':
+        return NpyFrameSource(filename, **kwargs)
+    elif extension in ('.tif', '.tiff'):
+        return TiffFrameSource(filename, **kwargs)
+    else:
+        return RawFrameSource(filename, **kwargs)
+
+
+class FrameSource():
+    """ Base class for frame sources. Sub-classes implement num_frames and
+    read_frame. Frames are returned by get_frame, which keeps up to
+    cacheSize frames in a least recently used cache. prefetch asks a
+    background thread to read the following frames into the cache.
+    """
+
+    cacheSize = 32
+    prefetchFrames = 8
+
+    def __init__(self, cacheSize = None, prefetchFrames = None):
+
+        if cacheSize is not None:
+            self.cacheSize = cacheSize
+        if prefetchFrames is not None:
+            self.prefetchFrames = prefetchFrames
+        self.cache = OrderedDict()
+        self.cacheLock = threading.Lock()
+        self.prefetchCondition = threading.Condition()
+        self.prefetchQueue = []
+        self.prefetchThread = None
+        self.closed = False
+
+
+    def num_frames(self):
+        """ Returns the number of frames.
+        """
+        raise NotImplementedError
+
+
+    def read_frame(self, index):
+        """ Reads frame `index` from the file and returns it as a numpy array.
+        This may be called from the prefetch thread.
+        """
+        raise NotImplementedError
+
+
+    def get_frame(self, index):
+        """ Returns frame `index` as a read-only numpy array, from the cache if
+        it has already been read.
+        """
+        if index < 0 or index >= self.num_frames():
+            raise IndexError("Frame " + str(index) + " out of range.")
+        with self.cacheLock:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return self.cache[index]
+        frame = self.read_frame(index)
+        return self.add_to_cache(index, frame)
+
+
+    def add_to_cache(self, index, frame):
+        """ Adds `frame` to the cache, discarding the least recently used
+        frames if the cache is full. Returns the read-only cached frame.
+        """
+        frame.setflags(write = False)
+        with self.cacheLock:
+            self.cache[index] = frame
+            self.cache.move_to_end(index)
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last = False)
+        return frame
+
+
+    def prefetch(self, index, direction = 1, loop = True):
+        """ Asks the prefetch thread to read the prefetchFrames frames starting
+        from `index` and moving in `direction` (1 or -1) into the cache. If
+        `loop` is True, frames wrap around from the end to the start. Replaces
+        any earlier request which has not been completed.
+        """
+        numFrames = self.num_frames()
+        indices = index + direction * np.arange(min(self.prefetchFrames, self.cacheSize - 1))
+        if loop:
+            indices = np.remainder(indices, numFrames)
+        else:
+            indices = indices[(indices >= 0) & (indices < numFrames)]
+
+        with self.prefetchCondition:
+            self.prefetchQueue = [int(i) for i in indices]
+            if self.prefetchThread is None:
+                self.prefetchThread = threading.Thread(target = self.prefetch_worker, daemon = True)
+                self.prefetchThread.start()
+            self.prefetchCondition.notify()
+
+
+    def prefetch_worker(self):
+        """ Reads frames requested by prefetch into the cache. Runs in the
+        prefetch thread until close is called. Frames which cannot be read are
+        skipped, so that the error is raised by get_frame when the frame is 
+        requested.
+        """
+        while True:
+            with self.prefetchCondition:
+                while not self.prefetchQueue and not self.closed:
+                    self.prefetchCondition.wait()
+                if self.closed:
+                    return
+                index = self.prefetchQueue.pop(0)
+            with self.cacheLock:
+                isCached = index in self.cache
+            if not isCached:
+                try:
+                    frame = self.read_frame(index)
+                except Exception:
+                    continue
+                self.add_to_cache(index, frame)
+
+
+    def clear_cache(self):
+        """ Removes all frames from the cache.
+        """
+        with self.cacheLock:
+            self.cache.clear()
+
+
+    def close(self):
+        """ Stops the prefetch thread and releases the cache.
+        """
+        with self.prefetchCondition:
+            self.closed = True
+            self.prefetchQueue = []
+            self.prefetchCondition.notify()
+        if self.prefetchThread is not None:
+            self.prefetchThread.join()
+            self.prefetchThread = None
+        self.clear_cache()
+
+
+class ArrayFrameSource(FrameSource):
+    """ Frame source for an array of shape (frames, height, width) or
+    (frames, height, width, channels), which can be a numpy memmap. Frames
+    are copied out of the array when read, so for a memmap only the frames
+    used are read from disk.
+    """
+
+    def __init__(self, array, **kwargs):
+
+        super().__init__(**kwargs)
+        self.array = array
+
+
+    def num_frames(self):
+        """ Returns the number of frames.
+        """
+        return np.shape(self.array)[0]
+
+
+    def read_frame(self, index):
+        """ Returns a copy of frame `index`.
+        """
+        return np.array(self.array[index])
+
+
+class NpyFrameSource(ArrayFrameSource):
+    """ Frame source for a .npy file containing an array of shape (frames,
+    height, width) or (frames, height, width, channels). The file is memory
+    mapped rather than loaded.
+    """
+
+    def __init__(self, filename, **kwargs):
+
+        super().__init__(np.load(filename, mmap_mode = 'r'), **kwargs)
+
+
+class RawFrameSource(ArrayFrameSource):
+    """ Frame source for a raw binary file of consecutive frames of
+    width x height pixels of type dtype, each with `channels` channels,
+    starting `offset` bytes into the file. The file is memory mapped and the
+    number of frames is determined from the file size.
+    """
+
+    def __init__(self, filename, width = None, height = None, dtype = 'uint8', channels = 1, offset = 0, **kwargs):
+
+        if width is None or height is None:
+            raise ValueError("The width and height of raw files must be specified.")
+        frameShape = (height, width) if channels == 1 else (height, width, channels)
+        frameBytes = int(np.prod(frameShape)) * np.dtype(dtype).itemsize
+        numFrames = (os.path.getsize(filename) - offset) // frameBytes
+        array = np.memmap(filename, dtype = dtype, mode = 'r', offset = offset, shape = (numFrames,) + frameShape)
+        super().__init__(array, **kwargs)
+
+
+class TiffFrameSource(FrameSource):
+    """ Frame source for a multi-page TIFF file, read using Pillow. Only the
+    pages used are decoded. Pillow cannot read a file from more than one
+    thread at once, so reads are serialised by a lock.
+    """
+
+    def __init__(self, filename, **kwargs):
+
+        from PIL import Image
+
+        super().__init__(**kwargs)
+        self.dataset = Image.open(filename)
+        self.numFrames = getattr(self.dataset, 'n_frames', 1)
+        self.readLock = threading.Lock()
+
+
+    def num_frames(self):
+        """ Returns the number of frames.
+        """
+        return self.numFrames
+
+
+    def read_frame(self, index):
+        """ Decodes page `index` of the file.
+        """
+        with self.readLock:
+            self.dataset.seek(index)
+            return np.array(self.dataset)
+
+
+    def close(self):
+        """ Stops the prefetch thread and closes the file.
+        """
+        super().close()
+        with self.readLock:
+            self.dataset.close()